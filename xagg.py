@@ -0,0 +1,191 @@
+#!/usr/local/bin/python
+
+__author__ = 'Amir Eshel <amir@eshel.com>'
+
+import json
+import math
+
+# Bounded-memory sketches for aggregation. Both merge, so that workers can
+# summarize their share of the lines and the parent combines the results.
+
+MASK64 = (1 << 64) - 1
+HLL_PRECISION = 12                      # 2^12 registers, ~1.6% error
+HLL_EXACT_LIMIT = 1 << (HLL_PRECISION - 4)  # Distinct hashes kept as a set below this
+TDIGEST_COMPRESSION = 100
+TDIGEST_BUFFER = 5 * TDIGEST_COMPRESSION
+
+
+def _hash64(val):
+    # hash() mixed with the murmur3 finalizer; equal JSON values (1 and 1.0
+    # included) hash alike, lists and dicts by their canonical JSON text
+    if isinstance(val, (list, dict)):
+        val = json.dumps(val, sort_keys=True)
+    h = hash(val) & MASK64
+    h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & MASK64
+    h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & MASK64
+    return h ^ (h >> 33)
+
+
+class HyperLogLog(object):
+    # Approximate distinct count. Small sets are counted exactly (by hash)
+    # and only switch to registers once they grow past HLL_EXACT_LIMIT.
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.hashes = set()
+        self.registers = None
+
+    def _to_registers(self):
+        self.registers = bytearray(1 << self.precision)
+        for h in self.hashes:
+            self._add_hash(h)
+        self.hashes = None
+
+    def _add_hash(self, h):
+        rest_bits = 64 - self.precision
+        idx = h >> rest_bits
+        rank = rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def add(self, val):
+        h = _hash64(val)
+        if self.registers is None:
+            self.hashes.add(h)
+            if len(self.hashes) > HLL_EXACT_LIMIT:
+                self._to_registers()
+        else:
+            self._add_hash(h)
+
+    def merge(self, other):
+        if self.registers is None and other.registers is None:
+            self.hashes.update(other.hashes)
+            if len(self.hashes) > HLL_EXACT_LIMIT:
+                self._to_registers()
+            return
+        if self.registers is None:
+            self._to_registers()
+        if other.registers is None:
+            for h in other.hashes:
+                self._add_hash(h)
+            return
+        mine = self.registers
+        for (idx, rank) in enumerate(other.registers):
+            if rank > mine[idx]:
+                mine[idx] = rank
+
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = len(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum([2.0 ** -r for r in self.registers])
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return int(round(m * math.log(float(m) / zeros)))
+        return int(round(estimate))
+
+
+class TDigest(object):
+    # Approximate quantiles from a merging t-digest: sorted (mean, weight)
+    # centroids that are small near the tails and larger around the median.
+    # Up to about compression values are kept exactly.
+
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.centroids = []
+        self.buffer = []
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.buffer.append((x, 1))
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+        if len(self.buffer) >= TDIGEST_BUFFER:
+            self._compress()
+
+    def merge(self, other):
+        if other.min is None:
+            return
+        self.buffer.extend(other.centroids)
+        self.buffer.extend(other.buffer)
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._compress()
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        total = sum([w for (x, w) in points])
+        centroids = []
+        cum = 0
+        (mean, weight) = points[0]
+        for (x, w) in points[1:]:
+            q = (cum + weight + w / 2.0) / total
+            limit = 4 * total * q * (1 - q) / self.compression
+            if weight + w <= max(limit, 1):
+                weight = weight + w
+                mean = mean + (x - mean) * float(w) / weight
+            else:
+                centroids.append((mean, weight))
+                cum = cum + weight
+                (mean, weight) = (x, w)
+        centroids.append((mean, weight))
+        self.centroids = centroids
+        self.buffer = []
+        self.total = total
+
+    def quantile(self, q):
+        # Interpolates between centroid centers, and towards min/max at the ends
+        self._compress()
+        if not self.centroids:
+            return None
+        target = q * self.total
+        (prev_center, prev_mean) = (0, self.min)
+        cum = 0
+        for (mean, weight) in self.centroids:
+            center = cum + weight / 2.0
+            if target < center:
+                if center == prev_center:
+                    return mean
+                return prev_mean + (mean - prev_mean) * (target - prev_center) / (center - prev_center)
+            (prev_center, prev_mean) = (center, mean)
+            cum = cum + weight
+        if self.total == prev_center:
+            return self.max
+        return prev_mean + (self.max - prev_mean) * (target - prev_center) / (self.total - prev_center)
+
+
+def format_value(val):
+    if val is None:
+        return '-'
+    if isinstance(val, float):
+        return '%.15g' % (val)       # Keeps epoch seconds exact
+    if isinstance(val, unicode):
+        return val.encode('utf-8')
+    return str(val)
+
+
+def format_table(header, rows):
+    # Columns padded to their widest value, numbers right aligned
+    texts = [[format_value(v) for v in row] for row in rows]
+    widths = [len(h) for h in header]
+    for row in texts:
+        widths = [max(w, len(t)) for (w, t) in zip(widths, row)]
+    lines = ['  '.join([h.ljust(w) for (h, w) in zip(header, widths)]).rstrip()]
+    for (row, text) in zip(rows, texts):
+        cells = []
+        for (v, t, w) in zip(row, text, widths):
+            if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                cells.append(t.rjust(w))
+            else:
+                cells.append(t.ljust(w))
+        lines.append('  '.join(cells).rstrip())
+    return '\n'.join(lines)
@@ -0,0 +1,315 @@
+#!/usr/local/bin/python
+
+__author__ = 'Amir Eshel <amir@eshel.com>'
+
+import sys
+import os
+import os.path
+import json
+import time
+import random
+import string
+import urllib
+import argparse
+import platform
+import tempfile
+import subprocess
+
+DEFAULT_LINES = 20000
+DEFAULT_DEPTH = 3
+DEFAULT_WIDTH = 4
+DEFAULT_ARRAY_SIZE = 8
+DEFAULT_CSV_FILES = 4
+DEFAULT_CSV_ROWS = 20000
+DEFAULT_CSV_COLUMNS = 12
+DEFAULT_KEY_OVERLAP = 0.5
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_SEED = 1
+
+LEVELS = ['debug', 'info', 'info', 'info', 'warn', 'error']
+
+# Name: xjson arguments, run once per beautify mode
+JSON_SCENARIOS = [
+    ('passthrough', []),
+    ('key_strip', ['-ks', 'request.user', '-ks', 'items.*.id']),
+    ('key_strip_wild', ['-ks', 'data.*.*.k0']),
+    ('key_expand', ['-ke', 'payload']),
+    ('key_expand_url', ['-kurl', 'request.url']),
+    ('key_unquote', ['-kunq', 'request.q']),
+    ('key_echo', ['-kecho', 'request.user']),
+    ('line_strip', ['-ls', 'level==error']),
+    ('array_sort', ['-asort', 'items:id']),
+]
+
+BEAUTIFY_MODES = ['none', 'array', 'dict']
+
+CONFLICT_MODES = ['keep', 'override', 'append', 'longer']
+
+
+def gen_json_value(rnd, depth, width, array_size):
+    if depth <= 0:
+        return rnd.choice([rnd.randint(0, 100000), 'v%d' % (rnd.randint(0, 1000)), rnd.random(), True, None])
+    d = {}
+    for k in range(width):
+        d['k%d' % (k)] = gen_json_value(rnd, depth - 1, width, array_size)
+    if array_size > 0:
+        d['list'] = [rnd.randint(0, 1000) for i in range(rnd.randint(0, array_size))]
+    return d
+
+
+def gen_json_line(rnd, line_no, depth, width, array_size):
+    query = [('id', line_no), ('page', rnd.randint(1, 50)), ('sort', rnd.choice(['asc', 'desc']))]
+    url = 'https://svc%d.example.com/api/v1/items/%d?%s#top' % (
+        rnd.randint(0, 9), rnd.randint(0, 99999), urllib.urlencode(query))
+    return {
+        'timestamp': 1500000000 + line_no,
+        'level': rnd.choice(LEVELS),
+        'host': 'host%02d' % (rnd.randint(0, 31)),
+        'request': {
+            'user': 'user%d' % (rnd.randint(0, 5000)),
+            'url': url,
+            'q': urllib.quote('name=%s value=%d&more' % (rnd.choice(['a b', 'c/d', 'e%f']), line_no)),
+        },
+        'payload': json.dumps(gen_json_value(rnd, depth, width, array_size)),
+        'data': gen_json_value(rnd, depth, width, array_size),
+        'items': [{'id': rnd.randint(0, 1000), 'name': 'item%d' % (i)} for i in range(array_size)],
+    }
+
+
+def gen_json_log(path, lines, depth=DEFAULT_DEPTH, width=DEFAULT_WIDTH,
+        array_size=DEFAULT_ARRAY_SIZE, seed=DEFAULT_SEED):
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        for line_no in range(lines):
+            f.write(json.dumps(gen_json_line(rnd, line_no, depth, width, array_size)) + '\n')
+
+
+def gen_csv_files(paths, rows, columns, key_overlap=DEFAULT_KEY_OVERLAP, seed=DEFAULT_SEED, key_column='Name'):
+    # Each file gets its own mix of columns. A key_overlap share of the keys
+    # is common to all files, the rest is unique to one file (merge conflicts).
+    rnd = random.Random(seed)
+    all_columns = ['c%02d' % (c) for c in range(columns * 2)]
+    shared = int(rows * key_overlap)
+    for (idx, path) in enumerate(paths):
+        cols = [key_column] + sorted(rnd.sample(all_columns, columns - 1))
+        with open(path, 'w') as f:
+            f.write(','.join(cols) + '\n')
+            for r in range(rows):
+                if r < shared:
+                    key = 'key%08d' % (r)
+                else:
+                    key = 'key%02d_%08d' % (idx, r)
+                vals = [rnd.choice(['', 'x', string.ascii_lowercase[:rnd.randint(1, 12)]]) for c in cols[1:]]
+                f.write(','.join([key] + vals) + '\n')
+
+
+def count_lines(path):
+    n = 0
+    with open(path, 'r') as f:
+        for l in f:
+            n = n + 1
+    return n
+
+
+def build_scenarios(opts):
+    # (name, tool, argv, input paths)
+    scenarios = []
+    log_path = os.path.join(opts.workdir, 'bench.log')
+    for (name, cmd_args) in JSON_SCENARIOS:
+        for beautify in BEAUTIFY_MODES:
+            out_path = os.path.join(opts.workdir, 'bench.%s.%s.out' % (name, beautify))
+            argv = cmd_args + ['-b', beautify, log_path, '-o', out_path]
+            scenarios.append(('xjson.%s.%s' % (name, beautify), 'xjson', argv, [log_path]))
+    csv_paths = [os.path.join(opts.workdir, 'bench%d.csv' % (idx)) for idx in range(opts.csv_files)]
+    for conflict in CONFLICT_MODES:
+        out_path = os.path.join(opts.workdir, 'bench.merge.%s.csv' % (conflict))
+        argv = ['-m', 'Name', '--conflict', conflict] + csv_paths + ['-o', out_path]
+        scenarios.append(('xcsv.merge.%s' % (conflict), 'xcsv', argv, csv_paths))
+    if opts.scenarios:
+        scenarios = [s for s in scenarios if any(pattern in s[0] for pattern in opts.scenarios)]
+    return scenarios
+
+
+def prepare_inputs(opts):
+    log_path = os.path.join(opts.workdir, 'bench.log')
+    if not os.path.exists(log_path):
+        gen_json_log(log_path, opts.lines, opts.depth, opts.width, opts.array_size, opts.seed)
+    # The files are generated together, the keys they share depend on it
+    csv_paths = [os.path.join(opts.workdir, 'bench%d.csv' % (idx)) for idx in range(opts.csv_files)]
+    if not all([os.path.exists(p) for p in csv_paths]):
+        gen_csv_files(csv_paths, opts.csv_rows, opts.csv_columns, opts.key_overlap, opts.seed)
+
+
+def run_one(tool, argv, result_path):
+    # Runs in a child process, so that its peak RSS belongs to one scenario
+    module = __import__(tool)
+    sys.argv = [tool + '.py'] + argv
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull
+    start = time.time()
+    try:
+        module.main(sys.argv)
+    finally:
+        seconds = time.time() - start
+        sys.stdout = stdout
+    with open(result_path, 'w') as f:
+        json.dump({'seconds': seconds}, f)
+
+
+def run_scenario(scenario, repeat, workdir):
+    (name, tool, argv, inpaths) = scenario
+    result_path = os.path.join(workdir, 'bench.result.json')
+    runs = []
+    peak_rss = 0
+    for r in range(repeat):
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', tool, result_path, '--'] + argv
+        proc = subprocess.Popen(cmd)
+        (pid, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        if status != 0:
+            raise RuntimeError('error: scenario %s failed (status %d)' % (name, status))
+        with open(result_path, 'r') as f:
+            runs.append(json.load(f)['seconds'])
+        peak_rss = max(peak_rss, rusage.ru_maxrss)
+    lines = sum([count_lines(p) for p in inpaths])
+    if tool == 'xcsv':
+        lines = lines - len(inpaths)    # Header lines aren't rows
+    size = sum([os.path.getsize(p) for p in inpaths])
+    seconds = min(runs)
+    return {
+        'name': name,
+        'lines': lines,
+        'bytes': size,
+        'seconds': seconds,
+        'runs': runs,
+        'lines_per_sec': lines / seconds if seconds > 0 else None,
+        'mb_per_sec': size / seconds / (1024 * 1024) if seconds > 0 else None,
+        'peak_rss_kb': peak_rss,
+    }
+
+
+def git_revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w'))
+        return rev.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(opts):
+    prepare_inputs(opts)
+    results = []
+    for scenario in build_scenarios(opts):
+        result = run_scenario(scenario, opts.repeat, opts.workdir)
+        if opts.verbose > 0:
+            sys.stderr.write('%-32s %10.0f lines/s %8.2f MB/s %8d KB\n' % (
+                result['name'], result['lines_per_sec'], result['mb_per_sec'], result['peak_rss_kb']))
+        results.append(result)
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {
+            'lines': opts.lines, 'depth': opts.depth, 'width': opts.width,
+            'array_size': opts.array_size, 'csv_files': opts.csv_files, 'csv_rows': opts.csv_rows,
+            'csv_columns': opts.csv_columns, 'key_overlap': opts.key_overlap,
+            'seed': opts.seed, 'repeat': opts.repeat,
+        },
+        'results': results,
+    }
+
+
+def compare_results(old, new, threshold=DEFAULT_THRESHOLD):
+    # Returns (name, old lines/s, new lines/s, ratio, regressed) per common scenario
+    old_by_name = dict([(r['name'], r) for r in old['results']])
+    rows = []
+    for r in new['results']:
+        o = old_by_name.get(r['name'])
+        if o is None or not o['lines_per_sec'] or not r['lines_per_sec']:
+            continue
+        ratio = r['lines_per_sec'] / o['lines_per_sec']
+        rows.append((r['name'], o['lines_per_sec'], r['lines_per_sec'], ratio, ratio < 1.0 - threshold))
+    return rows
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark xjson and xcsv on synthetic data',
+        fromfile_prefix_chars='@')
+    parser.add_argument('-v', action='count', dest='verbose', default=0,
+        help='print each result as it completes (to stderr)',)
+    parser.add_argument('-o', dest='outfile', type=str, metavar='OUT',
+        help='write JSON results to OUT (default: stdout)',)
+    parser.add_argument('-s', '--scenario', dest='scenarios', type=str, action='append', metavar='NAME',
+        help='only run scenarios whose name contains NAME',)
+    parser.add_argument('--list', dest='list', action='store_true',
+        help='list scenario names and exit',)
+    parser.add_argument('--compare', dest='compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two result files and exit (non-zero on a regression)',)
+    parser.add_argument('--threshold', dest='threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='lines/sec drop that counts as a regression with --compare',)
+    parser.add_argument('--workdir', dest='workdir', type=str, metavar='DIR',
+        help='where generated inputs are kept (and reused) between runs',)
+    parser.add_argument('--repeat', dest='repeat', type=int, default=DEFAULT_REPEAT,
+        help='runs per scenario, the fastest counts',)
+    parser.add_argument('--seed', dest='seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--lines', dest='lines', type=int, default=DEFAULT_LINES,
+        help='JSON-log lines',)
+    parser.add_argument('--depth', dest='depth', type=int, default=DEFAULT_DEPTH,
+        help='nesting depth of generated JSON subtrees',)
+    parser.add_argument('--width', dest='width', type=int, default=DEFAULT_WIDTH,
+        help='keys per generated JSON object',)
+    parser.add_argument('--array-size', dest='array_size', type=int, default=DEFAULT_ARRAY_SIZE,
+        help='maximal length of generated JSON arrays',)
+    parser.add_argument('--csv-files', dest='csv_files', type=int, default=DEFAULT_CSV_FILES)
+    parser.add_argument('--csv-rows', dest='csv_rows', type=int, default=DEFAULT_CSV_ROWS)
+    parser.add_argument('--csv-columns', dest='csv_columns', type=int, default=DEFAULT_CSV_COLUMNS)
+    parser.add_argument('--key-overlap', dest='key_overlap', type=float, default=DEFAULT_KEY_OVERLAP,
+        help='share of CSV keys present in all files',)
+    args = parser.parse_args(argv[1:])
+    if args.workdir is None:
+        # Inputs are reused only when generated with the same parameters
+        args.workdir = os.path.join(tempfile.gettempdir(), 'xbench-%d-%d-%d-%d-%d-%d-%d-%d-%g' % (
+            args.seed, args.lines, args.depth, args.width, args.array_size,
+            args.csv_files, args.csv_rows, args.csv_columns, args.key_overlap))
+    return args
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == '--run-one':
+        run_one(argv[2], argv[5:], argv[3])
+        return 0
+
+    args = parse_args(argv)
+
+    if args.compare:
+        old = json.load(open(args.compare[0], 'r'))
+        new = json.load(open(args.compare[1], 'r'))
+        regressions = 0
+        for (name, old_rate, new_rate, ratio, regressed) in compare_results(old, new, args.threshold):
+            print('%-32s %10.0f %10.0f %6.2fx%s' % (name, old_rate, new_rate, ratio, '  REGRESSION' if regressed else ''))
+            if regressed:
+                regressions = regressions + 1
+        return 1 if regressions else 0
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    if args.list:
+        for scenario in build_scenarios(args):
+            print(scenario[0])
+        return 0
+
+    report = json.dumps(run_benchmarks(args), indent=4, sort_keys=True)
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,203 @@
+#!/usr/local/bin/python
+
+__author__ = 'Amir Eshel <amir@eshel.com>'
+
+import sys
+import argparse
+import json
+
+DEFAULT_CODEC = 'auto'
+
+# Fastest first, 'auto' parses with the first one that is installed and
+# serializes with the stdlib, so that the output doesn't depend on what is
+# installed
+CODEC_PREFERENCE = [
+    'ujson',
+    'simplejson',
+    'json',
+]
+
+CODEC_CHOICES = [DEFAULT_CODEC] + CODEC_PREFERENCE
+
+# Fixture corpus for the conformance check, one JSON text per entry
+FIXTURES = [
+    '{}',
+    '[]',
+    '{"a": 1, "b": [1, 2, 3], "c": {"d": null, "e": true, "f": false}}',
+    '{"int": 12345678901234, "neg": -17, "zero": 0}',
+    '{"float": 1.5, "small": 1e-10, "big": 1.7976931348623157e+308, "neg": -0.25}',
+    '{"pi": 3.141592653589793, "third": 0.3333333333333333}',
+    '{"s": "plain", "empty": "", "spaces": "  a  b  "}',
+    '{"esc": "quote \\" backslash \\\\ slash \\/ tab \\t nl \\n cr \\r"}',
+    '{"ctl": "\\u0000\\u0001\\u001f", "bell": "\\b\\f"}',
+    '{"uni": "\\u00e9\\u4e2d\\u6587", "astral": "\\ud83d\\ude00"}',
+    '{"url": "http://example.com/p/a?x=1&y=%20z#frag"}',
+    '{"embedded": "{\\"x\\": 1, \\"y\\": [1, 2, {\\"z\\": \\"w\\"}]}"}',
+    '{"a.b": 1, "": 2, "0": [0, [1, [2, [3]]]]}',
+    '[1, "two", 3.0, null, {"five": [5]}]',
+    '{"nested": {"l1": {"l2": {"l3": {"l4": {"l5": "deep"}}}}}}',
+    '{"arr": [{"id": 3, "name": "c"}, {"id": 1, "name": "a"}, {"id": 2}]}',
+    '  {"ws" :  [ 1 ,2 ] }  ',
+]
+
+_codecs = {}
+
+
+def _load_json():
+    return {
+        'name': 'json',
+        'loads': json.loads,
+        'dumps': json.dumps,
+        'dumps_pretty': lambda o: json.dumps(o, indent=4, sort_keys=True),
+    }
+
+
+def _load_simplejson():
+    import simplejson
+    return {
+        'name': 'simplejson',
+        'loads': simplejson.loads,
+        'dumps': simplejson.dumps,
+        'dumps_pretty': lambda o: simplejson.dumps(o, indent=4, sort_keys=True),
+    }
+
+
+def _load_ujson():
+    # ujson only parses: its dumps (1.35, the last for Python 2) rounds floats
+    # to 15 decimals and writes compact separators
+    import ujson
+    codec = _load_json()
+    codec['name'] = 'ujson'
+    codec['loads'] = lambda s: ujson.loads(s, precise_float=True)
+    return codec
+
+
+CODEC_LOADERS = {
+    'json': _load_json,
+    'simplejson': _load_simplejson,
+    'ujson': _load_ujson,
+}
+
+
+def get_codec(name=DEFAULT_CODEC):
+    # Raises ImportError if the requested backend isn't installed
+    if name in _codecs:
+        return _codecs[name]
+    if name == DEFAULT_CODEC:
+        codec = _load_json()
+        for n in CODEC_PREFERENCE:
+            try:
+                codec['loads'] = get_codec(n)['loads']
+                codec['name'] = '%s (loads)' % (n)
+                break
+            except ImportError:
+                pass
+    else:
+        codec = CODEC_LOADERS[name]()
+    _codecs[name] = codec
+    return codec
+
+
+def available_codecs():
+    names = []
+    for n in CODEC_PREFERENCE:
+        try:
+            get_codec(n)
+            names.append(n)
+        except ImportError:
+            pass
+    return names
+
+
+def _same(a, b):
+    # Like ==, but 1 and 1.0 differ and dict/list contents are compared strictly
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return a == b
+    if type(a) != type(b):
+        if not (isinstance(a, (int, long)) and isinstance(b, (int, long))):
+            return False
+    if isinstance(a, dict):
+        if len(a) != len(b):
+            return False
+        for k in a:
+            if not k in b or not _same(a[k], b[k]):
+                return False
+        return True
+    if isinstance(a, list):
+        if len(a) != len(b):
+            return False
+        for (x, y) in zip(a, b):
+            if not _same(x, y):
+                return False
+        return True
+    return a == b
+
+
+def check_codec(name, corpus=FIXTURES):
+    # Returns (text, problem) for every corpus entry where the codec's
+    # parsing or serialization disagrees with the stdlib json module
+    ref = get_codec('json')
+    codec = get_codec(name)
+    failures = []
+    for text in corpus:
+        try:
+            expected = ref['loads'](text)
+        except ValueError:
+            continue
+        try:
+            if not _same(codec['loads'](text), expected):
+                failures.append((text, 'loads differs'))
+                continue
+            for dump in ['dumps', 'dumps_pretty']:
+                if not _same(ref['loads'](codec[dump](expected)), expected):
+                    failures.append((text, '%s differs' % (dump)))
+        except Exception as e:
+            failures.append((text, 'Error: %s' % (str(e))))
+    return failures
+
+
+def load_corpus(file_paths):
+    corpus = []
+    for path in file_paths:
+        for line in open(path, 'r'):
+            if line.strip():
+                corpus.append(line)
+    return corpus
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Check installed JSON codecs against the stdlib json module',
+        fromfile_prefix_chars='@')
+    parser.add_argument('-c', '--codec', dest='codecs',
+        type=str, action='append', choices=CODEC_PREFERENCE,
+        help='codec to check (default: all installed)',)
+    parser.add_argument('infiles', nargs='*', metavar='IN',
+        help='JSON-log files to use as corpus (default: built-in fixtures)',)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_args(argv)
+    corpus = FIXTURES
+    if args.infiles:
+        corpus = load_corpus(args.infiles)
+    names = args.codecs or available_codecs()
+    failed = 0
+    for name in names:
+        try:
+            failures = check_codec(name, corpus)
+        except ImportError:
+            print('%s: not installed' % (name))
+            failed = failed + 1
+            continue
+        for (text, problem) in failures:
+            print('%s: %s: %s' % (name, problem, text.strip()[:100]))
+        failed_texts = len(set([text for (text, problem) in failures]))
+        print('%s: %d/%d OK' % (name, len(corpus) - failed_texts, len(corpus)))
+        if failures:
+            failed = failed + 1
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
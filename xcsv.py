@@ -4,9 +4,16 @@ __author__ = 'Amir Eshel <amir@eshel.com>'
 
 import sys
 import argparse
-import json
 import os.path
-from xutils import expand_file_paths
+import heapq
+import marshal
+import csv
+import cStringIO
+import sqlite3
+import multiprocessing
+from xutils import expand_file_paths, find_chunks, spill_run, read_run
+from xutils import DEFAULT_CHUNK_SIZE, OUTPUT_BATCH_SIZE, DEFAULT_SORT_MEMORY, SORT_RECORD_OVERHEAD
+from xcodec import get_codec, CODEC_CHOICES, DEFAULT_CODEC
 
 DEFAULT_KEY = 'Name'
 DEFAULT_DELIM = ','
@@ -19,23 +26,73 @@ CONFLICT_CHOICES = {
 }
 
 DEFAULT_CONFLICT = 'keep'
+STORE_BATCH_ROWS = 10000                # Merged rows written to a --store at a time
 
 args = None
 
+def parse_rows(lines, columns, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM):
+    # Maps each (interned) key to the tuple of its values in the order of
+    # columns; the last row of a key wins and blank lines are skipped
+    key_idx = columns.index(key_column)
+    width = len(columns)
+    rows = {}
+    for l in lines:
+        if not l.strip():
+            continue
+        vals = split_row(l, width, delim)
+        rows[intern(vals[key_idx])] = vals
+    return rows
+
+
 def parse_lines(csv_lines, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM):
+    # Returns (rows, columns), see parse_rows
     columns = csv_lines[0].strip().split(delim)
-    dat = [dict(zip(columns, l.strip().split(delim))) for l in csv_lines[1:]]
-    rows = {}
-    for d in dat:
-        rows[d[key_column]] = d
-    return (rows, columns)
+    return (parse_rows(csv_lines[1:], columns, key_column, delim), columns)
 
 
 def parse_file(file_path, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM):
     return parse_lines(open(file_path, 'r').readlines(), key_column, delim)
 
 
-def parse_files(infiles, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM):
+def parse_chunk(task):
+    # Parses a byte range of the lines of a file in a pool worker
+    (file_path, columns, start, end, key_column, delim) = task
+    with open(file_path, 'r') as f:
+        f.seek(start)
+        lines = f.read(end - start).split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return parse_rows(lines, columns, key_column, delim)
+
+
+def parse_files_parallel(infiles, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    # parse_files with all files, split into line aligned chunks, parsed in a
+    # pool of jobs processes. The chunks of a file are combined in order, so
+    # the last row of a key still wins.
+    headers = []
+    tasks = []
+    for inf in infiles:
+        with open(inf, 'r') as f:
+            columns = f.readline().strip().split(delim)
+            start = f.tell()
+        headers.append(columns)
+        for (chunk_start, chunk_end) in find_chunks(inf, chunk_size, start):
+            tasks.append((len(headers) - 1, (inf, columns, chunk_start, chunk_end, key_column, delim)))
+    parsed = [({}, columns) for columns in headers]
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap(parse_chunk, [task for (idx, task) in tasks])
+    for ((idx, task), chunk_rows) in zip(tasks, results):
+        rows = parsed[idx][0]
+        for (k, vals) in chunk_rows.iteritems():
+            rows[intern(k)] = vals
+    pool.close()
+    pool.join()
+    return parsed
+
+
+def parse_files(infiles, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    if jobs > 1:
+        return parse_files_parallel(infiles, key_column, delim, jobs, chunk_size)
     return [parse_file(inf, key_column, delim) for inf in infiles]
 
 
@@ -50,73 +107,435 @@ def merge_columns(headers_list):
     return all_columns_list
 
 
-def merge_row(old, new, columns, on_conflict=DEFAULT_CONFLICT):
-    global args
-    merged = {}
-    mergekey = args.merge[0]
-
-    def valid(dct, key):
-        return (key in dct) and (not dct[key] is None) and (len(dct[key]) > 0)
-
-    for c in columns:
-        if valid(old, c) and valid(new, c) and old[c] != new[c]:
-            conflict_func = CONFLICT_CHOICES[on_conflict]
-            val = conflict_func(old[c], new[c])
-            if args.verbose and c != mergekey:
-                print('[CONFLICT] For %s="%s" in column %s: ["%s","%s"] --> %s' % 
-                    (mergekey, old[mergekey], c, old[c], new[c], val))
-        elif valid(old, c):
-            val = old[c]
-        elif valid(new, c):
-            val = new[c]
-        else:
-            val = None
-        merged[c] = val
-    return merged
-
-
-def merge_rows_from_tables(all_tables, all_columns, key_column=DEFAULT_KEY, on_conflict=DEFAULT_CONFLICT):
+def column_remap(columns, all_columns):
+    # (index in the file's row, index in all_columns) of each of a file's
+    # columns, in the order of all_columns (a repeated column's last value wins)
+    file_map = dict([(c, idx) for (idx, c) in enumerate(columns)])
+    return [(file_map[c], idx) for (idx, c) in enumerate(all_columns) if c in file_map]
+
+
+def split_row(l, width, delim=DEFAULT_DELIM):
+    # A line's values as a tuple of at least width values
+    vals = tuple(l.strip().split(delim))
+    if len(vals) < width:
+        vals = vals + ('',) * (width - len(vals))
+    return vals
+
+
+def conflict_reporter(all_columns, key_column):
+    key_idx = all_columns.index(key_column)
+
+    def report(old, idx, old_val, new_val, val):
+        if idx != key_idx:
+            print('[CONFLICT] For %s="%s" in column %s: ["%s","%s"] --> %s' %
+                (key_column, old[key_idx], all_columns[idx], old_val, new_val, val))
+    return report
+
+
+def merge_row(old, vals, remap, on_conflict=DEFAULT_CONFLICT, report=None):
+    # Merges a file's row (vals, mapped by column_remap) into old, a list
+    # aligned to all columns (None where empty). Empty values never win;
+    # differing ones are resolved by on_conflict and passed to report.
+    conflict_func = CONFLICT_CHOICES[on_conflict]
+    for (src, idx) in remap:
+        v = vals[src]
+        if not v:
+            continue
+        o = old[idx]
+        if o is None:
+            old[idx] = v
+        elif o != v:
+            val = conflict_func(o, v)
+            old[idx] = val
+            if report is not None:
+                report(old, idx, o, v, val)
+    return old
+
+
+def merge_rows_from_tables(all_tables, all_columns, key_column=DEFAULT_KEY, on_conflict=DEFAULT_CONFLICT, verbose=False):
+    # all_tables are (rows, columns) as returned by parse_lines; returns the
+    # merged rows as lists aligned to all_columns
+    report = conflict_reporter(all_columns, key_column) if verbose else None
+    width = len(all_columns)
     merged = {}
-    for table in all_tables:
-        for (k, row) in table.items():
-            if not k in merged:
-                merged[k] = dict()
-            merged[k] = merge_row(merged[k], row, all_columns, on_conflict)
+    for (table, columns) in all_tables:
+        remap = column_remap(columns, all_columns)
+        for (k, vals) in table.items():
+            old = merged.get(k)
+            if old is None:
+                old = [None] * width
+                merged[k] = old
+            merge_row(old, vals, remap, on_conflict, report)
     return merged
 
 
-def merge_files(file_paths, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, on_conflict=DEFAULT_CONFLICT):
-    parsed = parse_files(file_paths, key_column, delim)
+def merge_files(file_paths, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, on_conflict=DEFAULT_CONFLICT, verbose=False,
+        jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    parsed = parse_files(file_paths, key_column, delim, jobs, chunk_size)
     columns = merge_columns([p[1] for p in parsed])
-    rows = merge_rows_from_tables([p[0] for p in parsed], columns, key_column, on_conflict)
+    rows = merge_rows_from_tables(parsed, columns, key_column, on_conflict, verbose)
     return (rows, columns)
 
 
-def output_json(rows, columns, beautify=True):
-    if beautify:
-        return json.dumps(rows, indent=4, sort_keys=True)
+def sort_lines(lines, columns, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, sort_memory=DEFAULT_SORT_MEMORY):
+    # External merge sort of CSV lines by key_column: (key, line number, line)
+    # runs of up to sort_memory are spilled to temporary files and merged.
+    # The line number keeps rows with equal keys in input order.
+    key_idx = columns.index(key_column)
+    width = len(columns)
+    runs = []
+    run = []
+    run_size = 0
+    for (line_no, l) in enumerate(lines):
+        if not l.strip():
+            continue
+        run.append((split_row(l, width, delim)[key_idx], line_no, l))
+        run_size = run_size + len(l) + SORT_RECORD_OVERHEAD
+        if run_size >= sort_memory:
+            runs.append(spill_run(run, 'xcsv-sort-'))
+            run = []
+            run_size = 0
+    if not runs:
+        run.sort()
+        for (key, line_no, l) in run:
+            yield l
+        return
+    if run:
+        runs.append(spill_run(run, 'xcsv-sort-'))
+    run = None
+    for (key, line_no, l) in heapq.merge(*[read_run(f) for f in runs]):
+        yield l
+    for f in runs:
+        f.close()
+
+
+def sorted_rows(path, lines, columns, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM):
+    # (key, row) for lines sorted by key_column. Like parse_lines, the last
+    # of several rows with the same key wins.
+    key_idx = columns.index(key_column)
+    last = None
+    width = len(columns)
+    for l in lines:
+        if not l.strip():
+            continue
+        vals = split_row(l, width, delim)
+        k = vals[key_idx]
+        if last is not None:
+            if k < last[0]:
+                raise ValueError('error: %s is not sorted by %s (at "%s", use --presort)' % (path, key_column, k))
+            if k != last[0]:
+                yield last
+        last = (k, vals)
+    if last is not None:
+        yield last
+
+
+def open_sorted_table(file_path, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, presort=False, sort_memory=DEFAULT_SORT_MEMORY):
+    # Returns (columns, (key, row) iterator) reading the file as it goes
+    f = open(file_path, 'r')
+    columns = f.readline().strip().split(delim)
+    lines = f
+    if presort:
+        lines = sort_lines(f, columns, key_column, delim, sort_memory)
+    return (columns, sorted_rows(file_path, lines, columns, key_column, delim))
+
+
+def merge_sorted_files(file_paths, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, on_conflict=DEFAULT_CONFLICT,
+        presort=False, sort_memory=DEFAULT_SORT_MEMORY, verbose=False):
+    # Like merge_files for files sorted by key_column, but streaming: returns
+    # (rows, columns) where rows yields (key, merged row) in key order while
+    # holding only the current row of every file
+    opened = [open_sorted_table(p, key_column, delim, presort, sort_memory / max(len(file_paths), 1))
+        for p in file_paths]
+    columns = merge_columns([cols for (cols, rows) in opened])
+    remaps = [column_remap(cols, columns) for (cols, rows) in opened]
+    report = conflict_reporter(columns, key_column) if verbose else None
+
+    def tagged(idx, rows):
+        for (k, row) in rows:
+            yield (k, idx, row)
+
+    def merged_rows():
+        key = None
+        merged = None
+        for (k, idx, row) in heapq.merge(*[tagged(idx, rows) for (idx, (cols, rows)) in enumerate(opened)]):
+            if merged is not None and k != key:
+                yield (key, merged)
+                merged = None
+            if merged is None:
+                key = k
+                merged = [None] * len(columns)
+            merge_row(merged, row, remaps[idx], on_conflict, report)
+        if merged is not None:
+            yield (key, merged)
+
+    return (merged_rows(), columns)
+
+
+STORE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)',
+    'CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, path TEXT UNIQUE, '
+        'mtime REAL, size INTEGER, position INTEGER, columns BLOB)',
+    'CREATE TABLE IF NOT EXISTS source_rows (key TEXT, source_id INTEGER, vals BLOB, PRIMARY KEY (key, source_id))',
+    'CREATE INDEX IF NOT EXISTS source_rows_source ON source_rows (source_id)',
+    'CREATE TABLE IF NOT EXISTS merged (key TEXT PRIMARY KEY, vals BLOB)',
+    'CREATE TEMP TABLE touched (key TEXT PRIMARY KEY)',
+]
+
+
+def _store_meta(conn, name):
+    row = conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return None if row is None else marshal.loads(str(row[0]))
+
+
+def _set_store_meta(conn, name, value):
+    conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, buffer(marshal.dumps(value))))
+
+
+def _touch_source(conn, source_id):
+    conn.execute('INSERT OR IGNORE INTO touched SELECT key FROM source_rows WHERE source_id = ?', (source_id,))
+    conn.execute('DELETE FROM source_rows WHERE source_id = ?', (source_id,))
+
+
+def merge_store(store_path, file_paths, key_column=DEFAULT_KEY, delim=DEFAULT_DELIM, on_conflict=DEFAULT_CONFLICT, verbose=False,
+        jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Like merge_files, but incremental: the SQLite database at store_path
+    # keeps the rows of every source file (by absolute path, mtime and size)
+    # and the merged rows. Only new or changed files are parsed, and only the keys
+    # they (or removed files) hold are merged again, over all sources in the
+    # order of file_paths. Returns (rows, columns) where rows yields
+    # (key, merged row) in key order from the store.
+    file_paths = [os.path.abspath(path) for path in file_paths]
+    conn = sqlite3.connect(store_path)
+    conn.text_factory = str
+    for statement in STORE_SCHEMA:
+        conn.execute(statement)
+
+    # Rows parsed with another key or delimiter are of no use
+    if _store_meta(conn, 'parse') != (key_column, delim):
+        for table in ['sources', 'source_rows', 'merged']:
+            conn.execute('DELETE FROM %s' % (table))
+        _set_store_meta(conn, 'parse', (key_column, delim))
+
+    stored = {}
+    for (source_id, path, mtime, size, position) in conn.execute(
+            'SELECT id, path, mtime, size, position FROM sources'):
+        stored[path] = (source_id, mtime, size, position)
+    for path in set(stored) - set(file_paths):
+        _touch_source(conn, stored[path][0])
+        conn.execute('DELETE FROM sources WHERE id = ?', (stored[path][0],))
+
+    reordered = False
+    changed = []
+    for (position, path) in enumerate(file_paths):
+        st = os.stat(path)
+        old = stored.get(path)
+        if old is not None and (old[1], old[2]) == (st.st_mtime, st.st_size):
+            if old[3] != position:
+                reordered = True
+                conn.execute('UPDATE sources SET position = ? WHERE id = ?', (position, old[0]))
+            continue
+        if old is not None:
+            _touch_source(conn, old[0])
+            conn.execute('DELETE FROM sources WHERE id = ?', (old[0],))
+        if verbose:
+            print('Merging into store: %s' % (path))
+        changed.append((position, path, st))
+
+    # With jobs the changed files are parsed together in one pool, otherwise
+    # one at a time
+    changed_paths = [path for (position, path, st) in changed]
+    if jobs > 1 and changed:
+        parsed = iter(parse_files(changed_paths, key_column, delim, jobs, chunk_size))
     else:
-        return json.dumps(rows)
+        parsed = (parse_file(path, key_column, delim) for path in changed_paths)
+    for (position, path, st) in changed:
+        (rows, columns) = next(parsed)
+        source_id = conn.execute('INSERT INTO sources (path, mtime, size, position, columns) VALUES (?, ?, ?, ?, ?)',
+            (path, st.st_mtime, st.st_size, position, buffer(marshal.dumps(columns)))).lastrowid
+        conn.executemany('INSERT INTO source_rows VALUES (?, ?, ?)',
+            ((k, source_id, buffer(marshal.dumps(vals))) for (k, vals) in rows.iteritems()))
+        conn.executemany('INSERT OR IGNORE INTO touched VALUES (?)', ((k,) for k in rows))
+        rows = None
+
+    sources = {}
+    headers = []
+    for (source_id, columns) in conn.execute('SELECT id, columns FROM sources ORDER BY position'):
+        columns = marshal.loads(str(columns))
+        sources[source_id] = columns
+        headers.append(columns)
+    all_columns = merge_columns(headers)
+    for (source_id, columns) in sources.items():
+        sources[source_id] = column_remap(columns, all_columns)
+
+    # Merged rows stay valid while the conflict rule and the order of the
+    # sources hold, and the merged columns only grow at the end
+    old_columns = _store_meta(conn, 'columns') or []
+    if reordered or _store_meta(conn, 'conflict') != on_conflict or all_columns[:len(old_columns)] != old_columns:
+        conn.execute('DELETE FROM merged')
+        conn.execute('INSERT OR IGNORE INTO touched SELECT key FROM source_rows')
+    _set_store_meta(conn, 'conflict', on_conflict)
+    _set_store_meta(conn, 'columns', all_columns)
+
+    report = conflict_reporter(all_columns, key_column) if verbose else None
+    width = len(all_columns)
+
+    def remerged():
+        key = None
+        merged = None
+        for (k, source_id, vals) in conn.execute('SELECT r.key, r.source_id, r.vals FROM touched t '
+                'JOIN source_rows r ON r.key = t.key JOIN sources s ON s.id = r.source_id ORDER BY r.key, s.position'):
+            if merged is not None and k != key:
+                yield (key, buffer(marshal.dumps(merged)))
+                merged = None
+            if merged is None:
+                key = k
+                merged = [None] * width
+            merge_row(merged, marshal.loads(str(vals)), sources[source_id], on_conflict, report)
+        if merged is not None:
+            yield (key, buffer(marshal.dumps(merged)))
+
+    # Written in batches while the join is read, rather than all at once
+    batch = []
+    for merged_row in remerged():
+        batch.append(merged_row)
+        if len(batch) >= STORE_BATCH_ROWS:
+            conn.executemany('INSERT OR REPLACE INTO merged VALUES (?, ?)', batch)
+            batch = []
+    conn.executemany('INSERT OR REPLACE INTO merged VALUES (?, ?)', batch)
+    conn.execute('DELETE FROM merged WHERE key IN (SELECT key FROM touched) '
+        'AND NOT EXISTS (SELECT 1 FROM source_rows r WHERE r.key = merged.key)')
+    conn.execute('DELETE FROM touched')
+    conn.commit()
+
+    def stored_rows():
+        for (k, vals) in conn.execute('SELECT key, vals FROM merged ORDER BY key'):
+            row = marshal.loads(str(vals))
+            if len(row) < width:
+                row = row + [None] * (width - len(row))
+            yield (k, row)
+        conn.close()
+
+    return (stored_rows(), all_columns)
+
+
+def _json_framing(dumps):
+    # (head, separator, tail) the codec puts around the members of an object,
+    # so that members dumped one at a time join into the same text
+    probe = dumps({'a': 1, 'b': 2})
+    head = probe[:probe.index('"a"')]
+    sep = probe[probe.index('1') + 1:probe.index('"b"')]
+    tail = probe[probe.index('2') + 1:]
+    return (head, sep, tail)
+
+
+class CsvWriter(object):
+    # Writes (key, row) pairs as CSV in batches. Every value is followed by
+    # the delimiter (the last one too); the csv module quotes values that
+    # contain the delimiter, quotes or newlines.
+
+    def __init__(self, outfile, columns, delim=DEFAULT_DELIM, batch_size=OUTPUT_BATCH_SIZE):
+        self.outfile = outfile
+        self.columns = columns
+        self.delim = delim
+        self.batch_size = batch_size
+        self.buffer = cStringIO.StringIO()
+        self.rows = None
+        if len(delim) == 1:
+            self.rows = csv.writer(self.buffer, delimiter=delim, lineterminator='\n')
+
+    def _write_row(self, vals):
+        if self.rows is not None:
+            self.rows.writerow(vals + [''])
+        else:
+            self.buffer.write(''.join([v + self.delim for v in vals]) + '\n')
+
+    def begin(self):
+        self._write_row(self.columns)
+        self.flush()
+        self.outfile.flush()
+
+    def write(self, key, row):
+        self._write_row(['' if v is None else str(v) for v in row])
+        if self.buffer.tell() >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.outfile.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def end(self):
+        self.flush()
+
+
+class JsonWriter(object):
+    # Writes (key, row) pairs as the members of one JSON object in batches,
+    # the same text the codec would make of the whole {key: row} dict when
+    # the pairs come in that dict's order (sorted keys when beautified)
+
+    def __init__(self, outfile, columns, beautify=True, codec=DEFAULT_CODEC, batch_size=OUTPUT_BATCH_SIZE):
+        self.outfile = outfile
+        self.columns = columns
+        self.dumps = get_codec(codec)['dumps_pretty' if beautify else 'dumps']
+        (self.head, self.sep, self.tail) = _json_framing(self.dumps)
+        self.batch_size = batch_size
+        self.out_rows = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def begin(self):
+        pass
+
+    def write(self, key, row):
+        member = self.dumps({key: dict(zip(self.columns, row))})[len(self.head):-len(self.tail)]
+        self.pending.append(self.sep if self.out_rows > 0 else self.head)
+        self.pending.append(member)
+        self.out_rows = self.out_rows + 1
+        self.pending_size = self.pending_size + len(member)
+        if self.pending_size >= self.batch_size:
+            self.flush()
+            if self.out_rows == 1:
+                self.outfile.flush()
+
+    def flush(self):
+        if self.pending:
+            self.outfile.write(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def end(self):
+        self.pending.append(self.tail if self.out_rows > 0 else self.dumps({}))
+        self.flush()
+
+
+def open_writer(outfile, ext, columns, args):
+    if ext == 'txt':
+        return CsvWriter(outfile, columns, '\t')
+    elif ext == 'json':
+        return JsonWriter(outfile, columns, args.beautify, args.codec)
+    return CsvWriter(outfile, columns, args.delim)
+
+
+def write_rows(writer, rows):
+    writer.begin()
+    for (key, row) in rows:
+        writer.write(key, row)
+    writer.end()
+
+
+def output_json(rows, columns, beautify=True, codec=DEFAULT_CODEC):
+    out = cStringIO.StringIO()
+    rowitems = sorted(rows.items()) if beautify else rows.items()
+    write_rows(JsonWriter(out, columns, beautify, codec), rowitems)
+    return out.getvalue()
 
 
 def output_csv(rows, columns, delim=DEFAULT_DELIM, sort=True):
-    s = ''
-    for c in columns:
-        s += c + delim
-    s += '\n'
-    if sort:
-        rowitems = sorted(rows.items())
-    else:
-        rowitems = rows.items()
-    for (key, r) in rowitems:
-        for c in columns:
-            if r[c] is None:
-                val = ''
-            else:
-                val = str(r[c])
-            s += val + delim
-        s += '\n'
-    return s
+    out = cStringIO.StringIO()
+    rowitems = sorted(rows.items()) if sort else rows.items()
+    write_rows(CsvWriter(out, columns, delim), rowitems)
+    return out.getvalue()
 
 
 def parse_args(argv):
@@ -142,6 +561,24 @@ def parse_args(argv):
     parser.add_argument('--conflict', type=str, 
         choices=CONFLICT_CHOICES.keys(), default=DEFAULT_CONFLICT, dest='conflict',
         help='set delimiter to DELIM',)
+    parser.add_argument('--sorted', dest='sorted', action='store_true',
+        help='the input files are sorted by the merge COL: merge them streaming, holding one row per file in memory',)
+    parser.add_argument('--presort', dest='presort', action='store_true',
+        help='sort the input files by the merge COL (in temporary files when large) and merge them streaming',)
+    parser.add_argument('--sort-memory', dest='sort_memory',
+        default=DEFAULT_SORT_MEMORY, type=int, metavar='BYTES',
+        help='approximate memory used for --presort before spilling sorted runs to temporary files',)
+    parser.add_argument('--store', dest='store', type=str, metavar='DB',
+        help='keep the merged table in the SQLite database DB, so that a merge of the same files only re-merges the new or changed ones',)
+    parser.add_argument('-j', dest='jobs',
+        default=1, type=int, metavar='N',
+        help='parse the input files (large ones in chunks) using N worker processes, for merges in memory or into --store (not with --sorted or --presort)',)
+    parser.add_argument('--chunk-size', dest='chunk_size',
+        default=DEFAULT_CHUNK_SIZE, type=int, metavar='BYTES',
+        help='approximate size of the input chunks handed to each worker (with -j)',)
+    parser.add_argument('--codec', dest='codec',
+        default=DEFAULT_CODEC, choices=CODEC_CHOICES,
+        help='JSON library used to write .json output (default: the stdlib json module)',)
 
     args = parser.parse_args()
 
@@ -165,6 +602,12 @@ def parse_args(argv):
     if args.merge:
         if len(args.outfiles) > 1:
             raise SyntaxError('error: may supply up to 1 output file for merges')
+        if args.store and (args.sorted or args.presort):
+            raise SyntaxError('error: --store can not be combined with --sorted or --presort')
+        if args.jobs > 1 and (args.sorted or args.presort):
+            raise SyntaxError('error: -j can not be combined with --sorted or --presort (they merge streaming in one process)')
+    elif args.sorted or args.presort or args.store:
+        raise SyntaxError('error: --sorted, --presort and --store require a merge column (-m)')
 
     if (args.verbose >= 2):
         print('Ordered Arguments: ' + str(argv))
@@ -185,16 +628,18 @@ def main(argv):
     args = parse_args(argv)
 
     if args.merge:
-        (rows, cols) = merge_files(args.infiles, args.merge[0], args.delim, args.conflict)
+        if args.store:
+            (rows, cols) = merge_store(args.store, args.infiles, args.merge[0], args.delim, args.conflict, args.verbose,
+                args.jobs, args.chunk_size)
+        elif args.sorted or args.presort:
+            (rows, cols) = merge_sorted_files(args.infiles, args.merge[0], args.delim, args.conflict,
+                args.presort, args.sort_memory, args.verbose)
+        else:
+            (rows, cols) = merge_files(args.infiles, args.merge[0], args.delim, args.conflict, args.verbose,
+                args.jobs, args.chunk_size)
+            rows = sorted(rows.items()) if args.beautify else rows.items()
         with open(args.outfiles[0], 'w') as of:
-            ext = args.outext[0]
-            if ext == 'txt':
-                s = output_csv(rows, cols, '\t', args.beautify)
-            elif ext == 'json':
-                s = output_json(rows, cols, args.beautify)
-            else:
-                s = output_csv(rows, cols, args.delim, args.beautify)
-            of.write(s)
+            write_rows(open_writer(of, args.outext[0], cols, args), rows)
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -2,21 +2,43 @@
 
 __author__ = 'Amir Eshel <amir@eshel.com>'
 
-import json
 import sys
+import json
+import time
+import signal
 import argparse
 import string
 import urlparse
 import urllib
 import re
+import calendar
+import heapq
+import marshal
+import collections
 import os.path
-from xutils import expand_file_paths
+import multiprocessing
+from xutils import expand_file_paths, open_input, open_output, is_plain_file, output_path
+from xutils import read_line_batches, bounded_imap, find_chunks, spill_run, read_run, STDIO_PATH
+from xutils import DEFAULT_CHUNK_SIZE, OUTPUT_BATCH_SIZE, DEFAULT_SORT_MEMORY, SORT_RECORD_OVERHEAD
+from xcodec import get_codec, CODEC_CHOICES, DEFAULT_CODEC
+from xagg import HyperLogLog, TDigest, format_table
 
-in_lines = 0
-out_lines = 0
-in_file_name = ''
-out_file_name = ''
 args = None
+pool_args = None        # Arguments of a pool worker
+pool_cmds = None        # Compiled commands of a pool worker
+memo = None             # MemoCache of this process, see get_memo()
+
+DEFAULT_FOLLOW_INTERVAL = 1.0
+CHECKPOINT_SUFFIX = '.ckpt'
+INDEX_SUFFIX = '.xidx'
+INDEX_VERSION = 1
+DEFAULT_TIME_KEY = 'timestamp'
+EPOCH_MS_THRESHOLD = 1e11   # Larger epoch numbers are taken as milliseconds
+IO_BUFFER_SIZE = 1024 * 1024
+DEFAULT_MEMO_SIZE = 10000
+DEFAULT_PLAN_CACHE_SIZE = 256
+PLAN_ARRAY_BOUND = 16       # Lines with longer arrays are matched without a plan
+TIME_BUCKET_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
 
 def _fix_regexp(f):
@@ -34,11 +56,34 @@ def wildpath_compile(fstr):
     return re.compile(fstr)
 
 
+# Characters that let a wildpath match across a '.' once turned into a regexp
+WILDPATH_UNSAFE = set('\\[]|()^$+{}')
+WILDPATH_WILDCARDS = set('?*')
+
+
+def wildpath_segments(fstr):
+    # Splits a wildpath into per-key matchers: plain strings for literal keys,
+    # compiled regexps for wildcards. Returns None if it can't be split safely.
+    if WILDPATH_UNSAFE.intersection(fstr):
+        return None
+    segments = []
+    for seg in string.split(fstr, '.'):
+        if WILDPATH_WILDCARDS.intersection(seg):
+            segments.append(wildpath_compile(seg))
+        else:
+            segments.append(seg)
+    return segments
+
+
 def wildpath_filter(path_string, f):
     if isinstance(f, str):
         f = wildpath_compile(f)
     return f.match(path_string) is not None
 
+
+def _match_func(r):
+    return lambda p: (r.match(p) is not None)
+
 BEAUTIFY_CHOICES = [
     'none',
     'array',
@@ -52,6 +97,14 @@ FILTER_MODES = {
     "wildpath": lambda p, f: wildpath_filter(p, f),
 }
 
+# Same modes as FILTER_MODES, but each builds a single-argument matcher once
+FILTER_COMPILERS = {
+    "exact": lambda f: (lambda p: (p == f)),
+    "icase": lambda f: (lambda p, fl=f.lower(): (p.lower() == fl)),
+    "regexp": lambda f: _match_func(_fix_regexp(f)),
+    "wildpath": lambda f: _match_func(wildpath_compile(f)),
+}
+
 OPERATORS = {
     # Longer operator strings must come before short ones
     "~=": lambda a, b: (a.lower() == b.lower()),
@@ -66,18 +119,39 @@ OPERATORS = {
     ":": lambda a, b: (True),
 }
 
+OPERATORS_ORDER = sorted(OPERATORS.keys(), key=len, reverse=True)
+
 COMMANDS = [
     ('kecho', 'key_echo', 1),
     ('ke', 'key_expand', 1),
     ('kurl', 'key_expand_url', 1),
     ('kunq', 'key_unquote', 1),
-#       'line_keep',
+    ('lk', 'line_keep', 1),
     ('ls', 'line_strip', 1),
-#       'key_keep',
+    ('kk', 'key_keep', 1),
     ('ks', 'key_strip', 1),
     ('asort', 'array_sort', 1),
 ]
 
+# Commands that never modify the line they match
+READONLY_COMMANDS = [
+    'key_echo',
+    'line_keep',
+]
+
+# Commands that change lines they don't match
+KEEP_COMMANDS = [
+    'key_keep',
+    'line_keep',
+]
+
+# Commands that may add text the raw line doesn't hold
+EXPANDING_COMMANDS = [
+    'key_expand',
+    'key_expand_url',
+    'key_unquote',
+]
+
 
 def eval_operator(val, operand, operator_string):
     if operator_string is None:
@@ -89,7 +163,7 @@ def split_key_value_operator(selector_expr):
     k = None
     v = None
     oper = None
-    for o in OPERATORS.keys():
+    for o in OPERATORS_ORDER:
         if string.rfind(selector_expr, o) != -1:
             arglist = string.split(selector_expr, o, 1)
             oper = o
@@ -101,6 +175,25 @@ def split_key_value_operator(selector_expr):
     return (k, v, oper)
 
 
+def compile_selector(selector_expr, filter_mode='wildpath'):
+    (path_selector, operand, oper) = split_key_value_operator(selector_expr)
+    selector = {
+        'path_selector': path_selector,
+        'filter_mode': filter_mode,
+        'path_match': FILTER_COMPILERS[filter_mode](path_selector),
+        'segments': None,
+        'operator_name': oper,
+        'operator': None,
+        'operand': operand,
+        'plans': None,
+    }
+    if filter_mode == 'wildpath':
+        selector['segments'] = wildpath_segments(path_selector)
+    if oper is not None:
+        selector['operator'] = OPERATORS[oper]
+    return selector
+
+
 def jtree_path_select_one(path, path_selector, filter_mode='wildpath'):
     return FILTER_MODES[filter_mode](path, path_selector)
 
@@ -134,19 +227,383 @@ def jtree_all_paths(j):
     return paths
 
 
-def jtree_select(j, selector_expr=None):
-    all_paths = jtree_all_paths(j)
-    if selector_expr is not None:
-        (path_selector, val_expr, oper) = split_key_value_operator(selector_expr)
-        paths = jtree_path_select(all_paths, path_selector)
-        if oper is not None:
-            out = []
-            for p in paths:
-                if jtree_has_path(j, p):
-                    if eval_operator(jtree_get(j, p), val_expr, oper):
-                        out.append(p)
-            paths = out
-    return paths
+# How a matched node relates to jtree_get/jtree_has_path on its path string
+REACH_DICT = 0      # reached through dicts only: the node is what jtree_get returns
+REACH_LIST = 1      # crosses an array: jtree_has_path is False for it
+REACH_LOOKUP = 2    # crosses a key containing '.': only a lookup by path can tell
+
+
+def _seg_match(seg, k):
+    if isinstance(seg, str):
+        return k == seg
+    return seg.match(k) is not None
+
+
+def _has_dotted_keys(d):
+    for k in d:
+        if '.' in k:
+            return True
+    return False
+
+
+def _jtree_walk_segments(node, segments, depth, path, reach, out):
+    seg = segments[depth]
+    if isinstance(node, dict):
+        if isinstance(seg, str) and not _has_dotted_keys(node):
+            if not seg in node:
+                return
+            items = [(seg, node[seg])]
+        else:
+            items = node.items()
+        child_reach = reach
+    elif isinstance(node, list):
+        if isinstance(seg, str):
+            if not seg.isdigit() or str(int(seg)) != seg or int(seg) >= len(node):
+                return
+            items = [(int(seg), node[int(seg)])]
+        else:
+            items = enumerate(node)
+        child_reach = max(reach, REACH_LIST)
+    else:
+        return
+
+    for (k, v) in items:
+        if isinstance(k, int):
+            key = str(k)
+            if not _seg_match(seg, key):
+                continue
+            end = depth + 1
+            r = child_reach
+        elif '.' in k:
+            parts = string.split(k, '.')
+            end = depth + len(parts)
+            if end > len(segments):
+                continue
+            if not all(_seg_match(segments[depth + i], part) for (i, part) in enumerate(parts)):
+                continue
+            key = k
+            r = REACH_LOOKUP
+        else:
+            if not _seg_match(seg, k):
+                continue
+            key = k
+            end = depth + 1
+            r = child_reach
+        p = key if path is None else path + '.' + key
+        if end == len(segments):
+            out.append((p, node, k, v, r))
+        else:
+            _jtree_walk_segments(v, segments, end, p, r, out)
+
+
+def _jtree_walk_match(node, path_match, path, reach, out):
+    if isinstance(node, dict):
+        items = node.items()
+        child_reach = reach
+    elif isinstance(node, list):
+        items = enumerate(node)
+        child_reach = max(reach, REACH_LIST)
+    else:
+        return
+    for (k, v) in items:
+        key = k
+        r = child_reach
+        if isinstance(k, int):
+            key = str(k)
+        elif '.' in k:
+            r = REACH_LOOKUP
+        p = key if path is None else path + '.' + key
+        if path_match(p):
+            out.append((p, node, k, v, r))
+        _jtree_walk_match(v, path_match, p, r, out)
+
+
+def _jtree_walk(j, selector):
+    found = []
+    segments = selector['segments']
+    if segments is not None:
+        _jtree_walk_segments(j, segments, 0, None, REACH_DICT, found)
+    else:
+        _jtree_walk_match(j, selector['path_match'], None, REACH_DICT, found)
+    return found
+
+
+def _operand_nodes(j, found):
+    # The matches an operator applies to, with the value it is applied to
+    out = []
+    for (p, parent, k, v, r) in found:
+        if not p:
+            continue
+        if r == REACH_LOOKUP:
+            if not jtree_has_path(j, p):
+                continue
+            v = jtree_get(j, p)
+        elif r == REACH_LIST:
+            continue
+        out.append((p, parent, k, v))
+    return out
+
+
+def jtree_select_nodes(j, selector):
+    # Returns (path, parent, key, node) for every match, in jtree_all_paths order
+    if isinstance(selector, str):
+        selector = compile_selector(selector)
+    found = _jtree_walk(j, selector)
+    operator = selector['operator']
+    if operator is None:
+        return [(p, parent, k, v) for (p, parent, k, v, r) in found]
+    operand = selector['operand']
+    return [m for m in _operand_nodes(j, found) if operator(m[3], operand)]
+
+
+def shape_fingerprint(node, segments, depth=0):
+    # The part of a line's key layout that decides which paths the selector
+    # segments match: literal segments only note the key they look up,
+    # wildcard ones every key. None when such an array is longer than
+    # PLAN_ARRAY_BOUND.
+    if depth == len(segments):
+        return 0
+    seg = segments[depth]
+    if isinstance(node, dict):
+        if isinstance(seg, str) and not _has_dotted_keys(node):
+            if not seg in node:
+                return 4
+            return (3, shape_fingerprint(node[seg], segments, depth + 1))
+        shape = [1]
+        for (k, v) in node.iteritems():
+            end = depth + 1
+            if '.' in k:
+                end = min(depth + k.count('.') + 1, len(segments))
+            s = shape_fingerprint(v, segments, end)
+            if s is None:
+                return None
+            shape.append(k)
+            shape.append(s)
+        return tuple(shape)
+    if isinstance(node, list):
+        if isinstance(seg, str):
+            if not seg.isdigit() or str(int(seg)) != seg or int(seg) >= len(node):
+                return 4
+            return (5, shape_fingerprint(node[int(seg)], segments, depth + 1))
+        if len(node) > PLAN_ARRAY_BOUND:
+            return None
+        shape = [2]
+        for v in node:
+            s = shape_fingerprint(v, segments, depth + 1)
+            if s is None:
+                return None
+            shape.append(s)
+        return tuple(shape)
+    return 0
+
+
+class PlanCache(object):
+    # Matching paths of one selector by line shape, emptied when full
+
+    def __init__(self, size):
+        self.size = size
+        self.plans = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint):
+        plan = self.plans.get(fingerprint)
+        if plan is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+        return plan
+
+    def put(self, fingerprint, plan):
+        if len(self.plans) >= self.size:
+            self.plans.clear()
+        self.plans[fingerprint] = plan
+
+
+def _select_plan(j, selector):
+    # The paths jtree_select returns for every line shaped like j, before any
+    # operator is evaluated on their values
+    found = _jtree_walk(j, selector)
+    if selector['operator'] is None:
+        return tuple([m[0] for m in found])
+    return tuple([m[0] for m in _operand_nodes(j, found)])
+
+
+def jtree_select(j, selector=None):
+    if selector is None:
+        return jtree_all_paths(j)
+    plans = None
+    if isinstance(selector, dict):
+        plans = selector['plans']
+    if plans is not None:
+        fingerprint = shape_fingerprint(j, selector['segments'])
+        if fingerprint is not None:
+            plan = plans.get(fingerprint)
+            if plan is None:
+                plan = _select_plan(j, selector)
+                plans.put(fingerprint, plan)
+            operator = selector['operator']
+            if operator is None:
+                return list(plan)
+            operand = selector['operand']
+            return [p for p in plan if operator(jtree_get(j, p), operand)]
+    return [m[0] for m in jtree_select_nodes(j, selector)]
+
+
+# Path regexps of the filter modes whose selectors can share one alternation
+ALTERNATION_PATTERNS = {
+    "regexp": lambda f: _fix_regexp(f).pattern,
+    "wildpath": lambda f: wildpath_compile(f).pattern,
+}
+
+
+def _trie_node():
+    return {'lit': {}, 'wild': [], 'ends': []}
+
+
+def compile_multi_selector(selectors):
+    # One matcher for many selectors: a trie of the segments of the ones that
+    # split into segments, a single alternation regexp for the others
+    trie = None
+    alternated = []
+    for (idx, selector) in enumerate(selectors):
+        segments = selector['segments']
+        if segments is None:
+            alternated.append(idx)
+            continue
+        if trie is None:
+            trie = _trie_node()
+        t = trie
+        for seg in segments:
+            if isinstance(seg, str):
+                t = t['lit'].setdefault(seg, _trie_node())
+                continue
+            for (r, child) in t['wild']:
+                if r.pattern == seg.pattern:
+                    t = child
+                    break
+            else:
+                child = _trie_node()
+                t['wild'].append((seg, child))
+                t = child
+        t['ends'].append(idx)
+    alternation = None
+    if alternated:
+        patterns = [ALTERNATION_PATTERNS[selectors[idx]['filter_mode']](selectors[idx]['path_selector']) for idx in alternated]
+        alternation = re.compile('|'.join(['(?:%s)' % (pattern) for pattern in patterns]))
+    return {
+        'selectors': selectors,
+        'trie': trie,
+        'alternation': alternation,
+        'alternated': alternated,
+    }
+
+
+def _trie_step(states, part):
+    out = []
+    for t in states:
+        child = t['lit'].get(part)
+        if child is not None:
+            out.append(child)
+        for (r, child) in t['wild']:
+            if r.match(part) is not None:
+                out.append(child)
+    return out
+
+
+def _jtree_walk_trie(node, states, path, reach, found):
+    # _jtree_walk_segments for all the selectors of a trie at once; states are
+    # the trie nodes reached by the path so far
+    literal = True
+    for t in states:
+        if t['wild']:
+            literal = False
+            break
+    if isinstance(node, dict):
+        if literal and not _has_dotted_keys(node):
+            keys = set()
+            for t in states:
+                keys.update(t['lit'])
+            items = [(k, node[k]) for k in keys if k in node]
+        else:
+            items = node.items()
+        child_reach = reach
+    elif isinstance(node, list):
+        if literal:
+            indexes = set()
+            for t in states:
+                for seg in t['lit']:
+                    if seg.isdigit() and str(int(seg)) == seg and int(seg) < len(node):
+                        indexes.add(int(seg))
+            items = [(idx, node[idx]) for idx in indexes]
+        else:
+            items = enumerate(node)
+        child_reach = max(reach, REACH_LIST)
+    else:
+        return
+
+    for (k, v) in items:
+        if isinstance(k, int):
+            key = str(k)
+            next_states = _trie_step(states, key)
+            r = child_reach
+        elif '.' in k:
+            key = k
+            next_states = states
+            for part in string.split(k, '.'):
+                next_states = _trie_step(next_states, part)
+            r = REACH_LOOKUP
+        else:
+            key = k
+            next_states = _trie_step(states, key)
+            r = child_reach
+        if not next_states:
+            continue
+        p = key if path is None else path + '.' + key
+        deeper = []
+        for t in next_states:
+            for idx in t['ends']:
+                found[idx].append((p, node, k, v, r))
+            if t['lit'] or t['wild']:
+                deeper.append(t)
+        if deeper:
+            _jtree_walk_trie(v, deeper, p, r, found)
+
+
+def _jtree_walk_alternation(node, multi, path, reach, found):
+    # _jtree_walk_match for all the alternated selectors at once
+    if isinstance(node, dict):
+        items = node.items()
+        child_reach = reach
+    elif isinstance(node, list):
+        items = enumerate(node)
+        child_reach = max(reach, REACH_LIST)
+    else:
+        return
+    selectors = multi['selectors']
+    for (k, v) in items:
+        key = k
+        r = child_reach
+        if isinstance(k, int):
+            key = str(k)
+        elif '.' in k:
+            r = REACH_LOOKUP
+        p = key if path is None else path + '.' + key
+        if multi['alternation'].match(p) is not None:
+            for idx in multi['alternated']:
+                if selectors[idx]['path_match'](p):
+                    found[idx].append((p, node, k, v, r))
+        _jtree_walk_alternation(v, multi, p, r, found)
+
+
+def jtree_multi_walk(j, multi):
+    # Walks j once; returns for each selector what _jtree_walk would find
+    found = [[] for selector in multi['selectors']]
+    if multi['trie'] is not None:
+        _jtree_walk_trie(j, [multi['trie']], None, REACH_DICT, found)
+    if multi['alternation'] is not None:
+        _jtree_walk_alternation(j, multi, None, REACH_DICT, found)
+    return found
 
 
 def _jtree_get_list(json_line, keys_list):
@@ -253,6 +710,41 @@ def jtree_has_path(j, full_key_name):
     return _jtree_has_path_list(j, path)
 
 
+def _jtree_project(node, path, keep, prefixes):
+    # Keys are inserted sorted so the result doesn't depend on how node was built
+    if isinstance(node, dict):
+        out = {}
+        for k in sorted(node):
+            p = k if path is None else path + '.' + k
+            if p in keep:
+                out[k] = node[k]
+            elif p in prefixes:
+                out[k] = _jtree_project(node[k], p, keep, prefixes)
+        return out
+    if isinstance(node, list):
+        out = []
+        for (idx, v) in enumerate(node):
+            p = str(idx) if path is None else path + '.' + str(idx)
+            if p in keep:
+                out.append(v)
+            elif p in prefixes:
+                out.append(_jtree_project(v, p, keep, prefixes))
+        return out
+    return node
+
+
+def jtree_project(j, paths):
+    # A copy of j with only the given paths (and the containers above them);
+    # arrays keep only their selected items
+    keep = set(paths)
+    prefixes = set()
+    for p in paths:
+        parts = string.split(p, '.')
+        for i in range(1, len(parts)):
+            prefixes.add('.'.join(parts[:i]))
+    return _jtree_project(j, None, keep, prefixes)
+
+
 def jtree_is_array(j, path):
     val = jtree_get(j, path)
     return isinstance(val, list)
@@ -272,69 +764,472 @@ def jtree_path_father(path):
 
 
 def output_line(json_line, args):
+    codec = get_codec(args.codec)
     if args.beautify != 'none':
-        return json.dumps(json_line, indent=4, sort_keys=True)
+        return codec['dumps_pretty'](json_line)
     else:
-        return json.dumps(json_line)
+        return codec['dumps'](json_line)
+
+
+def output_header(beautify):
+    if beautify == 'array':
+        return '[\n'
+    elif beautify == 'dict':
+        return '{\n'
+    return ''
+
+
+def output_footer(beautify):
+    if beautify == 'array':
+        return '\n]'
+    elif beautify == 'dict':
+        return '\n}'
+    return ''
+
+
+class OutputWriter(object):
+    # Frames output lines according to -b and writes them in large batches
+
+    def __init__(self, outfile, beautify, batch_size=OUTPUT_BATCH_SIZE):
+        self.outfile = outfile
+        self.beautify = beautify
+        self.batch_size = batch_size
+        self.separator = '\n' if beautify == 'none' else ',\n'
+        self.out_lines = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def begin(self):
+        self.pending.append(output_header(self.beautify))
+
+    def write(self, oline, in_line_no):
+        if self.out_lines > 0:
+            self.pending.append(self.separator)
+        if self.beautify == 'dict':
+            self.pending.append('"%d": ' % (in_line_no))
+        self.pending.append(oline)
+        self.out_lines = self.out_lines + 1
+        self.pending_size = self.pending_size + len(oline)
+        if self.pending_size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.outfile.write(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def end(self):
+        self.pending.append(output_footer(self.beautify))
+        self.flush()
+
+    def commit(self):
+        # Makes the output valid as it stands (footer included) and durable.
+        # Returns the offset to resume from; the next write replaces the footer.
+        self.flush()
+        offset = self.outfile.tell()
+        self.outfile.write(output_footer(self.beautify))
+        self.outfile.truncate()
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+        self.outfile.seek(offset)
+        return offset
+
+
+class MemoCache(object):
+    # Bounded LRU cache of decoded values, keyed by (command, input string).
+    # Values are kept marshalled so every hit returns a fresh copy that the
+    # caller is free to modify.
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        entries = self.entries
+        data = entries.pop(key, None)
+        if data is not None:
+            entries[key] = data
+            self.hits = self.hits + 1
+            return marshal.loads(data)
+        self.misses = self.misses + 1
+        val = compute(key[1])
+        if len(entries) >= self.size:
+            entries.popitem(last=False)
+        entries[key] = marshal.dumps(val)
+        return val
 
 
-def trace_msg(msg):
-    global in_lines
-    global args
-    global in_file_name
-    in_line_no = in_lines
-    if (args.trace):
-        print('%s[%03d]\t%s' % (in_file_name, in_line_no, msg))
+def get_memo(args):
+    # One cache per process, shared by all the files and chunks it handles
+    global memo
+    if memo is None and args.memo_size > 0:
+        memo = MemoCache(args.memo_size)
+    return memo
+
+
+def memo_call(ctx, command, v, func):
+    if ctx.memo is None or not isinstance(v, basestring):
+        return func(v)
+    return ctx.memo.get((command, v), func)
+
+
+def _plan_counts(cmd):
+    plans = cmd.get('plans')
+    if plans is None:
+        return (0, 0)
+    return (plans.hits, plans.misses)
+
+
+class ProcessStats(object):
+    # Counters and timers for --stats. Workers fill their own and the parent
+    # merges them (to_dict/merge); only the parent's instance reports.
+
+    def __init__(self, cmds, outpath=None, interval=0, memo=None):
+        self.outpath = outpath
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.in_lines = 0
+        self.out_lines = 0
+        self.skipped = 0
+        self.phases = {'parse': 0.0, 'transform': 0.0, 'serialize': 0.0}
+        self.commands = [{
+            'command': cmd['command'],
+            'selector': cmd['selector'],
+            'invocations': 0,
+            'matches': 0,
+            'errors': 0,
+            'seconds': 0.0,
+            'plan_hits': 0,
+            'plan_misses': 0,
+        } for cmd in cmds]
+        self.cmds = cmds
+        self.plan_base = [_plan_counts(cmd) for cmd in cmds]
+        self.files = []
+        # Counters of this process' cache count from here, merged ones add up
+        self.memo = memo
+        self.memo_base = (memo.hits, memo.misses) if memo is not None else (0, 0)
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    def add_file(self, ctx, seconds):
+        self.files.append({
+            'path': ctx.in_path,
+            'in_lines': ctx.in_lines,
+            'out_lines': ctx.out_lines,
+            'seconds': seconds,
+            'lines_per_sec': ctx.in_lines / seconds if seconds > 0 else None,
+        })
+
+    def to_dict(self, final=False):
+        elapsed = time.time() - self.start
+        memo_hits = self.memo_hits
+        memo_misses = self.memo_misses
+        if self.memo is not None:
+            memo_hits = memo_hits + self.memo.hits - self.memo_base[0]
+            memo_misses = memo_misses + self.memo.misses - self.memo_base[1]
+        commands = []
+        for (cmd_stats, cmd, base) in zip(self.commands, self.cmds, self.plan_base):
+            (hits, misses) = _plan_counts(cmd)
+            cmd_stats = dict(cmd_stats)
+            cmd_stats['plan_hits'] = cmd_stats['plan_hits'] + hits - base[0]
+            cmd_stats['plan_misses'] = cmd_stats['plan_misses'] + misses - base[1]
+            commands.append(cmd_stats)
+        return {
+            'final': final,
+            'elapsed': elapsed,
+            'in_lines': self.in_lines,
+            'out_lines': self.out_lines,
+            'skipped': self.skipped,
+            'lines_per_sec': self.in_lines / elapsed if elapsed > 0 else None,
+            'phases': self.phases,
+            'commands': commands,
+            'files': self.files,
+            'memo_hits': memo_hits,
+            'memo_misses': memo_misses,
+        }
+
+    def merge(self, d):
+        self.in_lines = self.in_lines + d['in_lines']
+        self.out_lines = self.out_lines + d['out_lines']
+        self.skipped = self.skipped + d['skipped']
+        for (phase, seconds) in d['phases'].items():
+            self.phases[phase] = self.phases[phase] + seconds
+        for (mine, theirs) in zip(self.commands, d['commands']):
+            for k in ['invocations', 'matches', 'errors', 'seconds', 'plan_hits', 'plan_misses']:
+                mine[k] = mine[k] + theirs[k]
+        self.files.extend(d['files'])
+        self.memo_hits = self.memo_hits + d['memo_hits']
+        self.memo_misses = self.memo_misses + d['memo_misses']
+
+    def report(self, final=False):
+        self.last_report = time.time()
+        if self.outpath is None:
+            return
+        s = json.dumps(self.to_dict(final), sort_keys=True) + '\n'
+        if self.outpath == STDIO_PATH:
+            sys.stderr.write(s)
+        else:
+            with open(self.outpath, 'a') as f:
+                f.write(s)
+
+    def maybe_report(self, now):
+        if self.interval and now - self.last_report >= self.interval:
+            self.report()
 
 
-def process_path_command(json_line, path, command):
+def _is_number(val):
+    return isinstance(val, (int, long, float)) and not isinstance(val, bool)
+
+
+def _agg_min(s, v):
+    return v if s is None or v < s else s
+
+
+def _agg_max(s, v):
+    return v if s is None or v > s else s
+
+
+def _sketch_add(s, v):
+    s.add(v)
+    return s
+
+
+def _sketch_merge(a, b):
+    a.merge(b)
+    return a
+
+
+def _avg_result(s):
+    return s[0] / float(s[1]) if s[1] else None
+
+
+# Metric: (values it takes, new state, add value, merge states, result).
+# Percentiles (pNN) are looked up as 'p'. Missing (null) values are skipped.
+AGG_METRICS = {
+    'count': (None, lambda: 0, lambda s, v: s + 1, lambda a, b: a + b, lambda s: s),
+    'sum': (_is_number, lambda: 0, lambda s, v: s + v, lambda a, b: a + b, lambda s: s),
+    'min': (_is_number, lambda: None, _agg_min, lambda a, b: a if b is None else _agg_min(a, b), lambda s: s),
+    'max': (_is_number, lambda: None, _agg_max, lambda a, b: a if b is None else _agg_max(a, b), lambda s: s),
+    'avg': (_is_number, lambda: (0, 0), lambda s, v: (s[0] + v, s[1] + 1), lambda a, b: (a[0] + b[0], a[1] + b[1]), _avg_result),
+    'distinct': (None, HyperLogLog, _sketch_add, _sketch_merge, lambda s: s.count()),
+    'p': (_is_number, TDigest, _sketch_add, _sketch_merge, None),
+}
+
+PERCENTILE_RE = re.compile(r'^p(\d+(?:\.\d+)?)$')
+
+
+def parse_metric(spec):
+    # "count", "count:KEY", "sum:KEY", "p95:KEY", ... -> (spec, metric, KEY, quantile)
+    (name, sep, path) = spec.partition(':')
+    if not path:
+        path = None
+    quantile = None
+    m = PERCENTILE_RE.match(name)
+    if m is not None:
+        quantile = float(m.group(1)) / 100
+        if quantile > 1:
+            raise SyntaxError('error: percentile out of range in --agg %s' % (spec))
+        name = 'p'
+    if name not in AGG_METRICS:
+        raise SyntaxError('error: unknown --agg metric "%s" (expected count, sum, min, max, avg, distinct or pNN)' % (spec))
+    if path is None and name != 'count':
+        raise SyntaxError('error: --agg %s needs a key, e.g. %s:KEY' % (spec, spec))
+    return (spec, name, path, quantile)
+
+
+def parse_group_key(spec):
+    # "KEY" or "KEY/SECONDS", which groups the times in KEY by SECONDS buckets
+    (path, sep, bucket) = spec.rpartition('/')
+    if sep:
+        try:
+            return (spec, path, float(bucket))
+        except ValueError:
+            pass
+    return (spec, spec, None)
+
+
+def group_value(val, bucket):
+    if bucket is not None:
+        t = parse_time(val)
+        if t is None:
+            return None
+        return (t // bucket) * bucket
+    if isinstance(val, (list, dict)):
+        return json.dumps(val, sort_keys=True)
+    return val
+
+
+class Aggregator(object):
+    # Per group-by key, the states of the --agg metrics. Workers aggregate
+    # their lines and the parent merges the groups; only the parent prints.
+
+    def __init__(self, group_by, metrics):
+        self.group_by = group_by
+        self.metrics = metrics
+        self.funcs = [AGG_METRICS[name] for (spec, name, path, quantile) in metrics]
+        self.lines = 0
+        self.groups = {}
+
+    def add(self, json_line):
+        key = tuple([group_value(jtree_get(json_line, path), bucket) for (spec, path, bucket) in self.group_by])
+        states = self.groups.get(key)
+        if states is None:
+            states = [new() for (accepts, new, add, merge, result) in self.funcs]
+            self.groups[key] = states
+        for (idx, (spec, name, path, quantile)) in enumerate(self.metrics):
+            (accepts, new, add, merge, result) = self.funcs[idx]
+            if path is not None:
+                v = jtree_get(json_line, path)
+                if v is None or (accepts is not None and not accepts(v)):
+                    continue
+            else:
+                v = None
+            states[idx] = add(states[idx], v)
+        self.lines = self.lines + 1
+
+    def to_dict(self):
+        return {'lines': self.lines, 'groups': self.groups}
+
+    def merge(self, d):
+        self.lines = self.lines + d['lines']
+        for (key, theirs) in d['groups'].items():
+            mine = self.groups.get(key)
+            if mine is None:
+                self.groups[key] = theirs
+                continue
+            for (idx, (accepts, new, add, merge, result)) in enumerate(self.funcs):
+                mine[idx] = merge(mine[idx], theirs[idx])
+
+    def rows(self):
+        rows = []
+        for key in sorted(self.groups, key=lambda k: tuple([sort_value(v) for v in k])):
+            row = []
+            for (v, (spec, path, bucket)) in zip(key, self.group_by):
+                if bucket is not None and v is not None:
+                    v = time.strftime(TIME_BUCKET_FORMAT, time.gmtime(v))
+                row.append(v)
+            for (state, (spec, name, path, quantile), funcs) in zip(self.groups[key], self.metrics, self.funcs):
+                if name == 'p':
+                    row.append(state.quantile(quantile))
+                else:
+                    row.append(funcs[4](state))
+            rows.append(row)
+        return rows
+
+    def table(self):
+        header = [spec for (spec, path, bucket) in self.group_by] + [spec for (spec, name, path, quantile) in self.metrics]
+        return format_table(header, self.rows())
+
+
+def say(args, msg):
+    # Progress and diagnostic output, on stderr when stdout carries the data
+    if STDIO_PATH in args.outfiles:
+        sys.stderr.write(msg + '\n')
+    else:
+        print(msg)
+
+
+class LogContext(object):
+    # Per-file processing state, one per job (file, or chunk of a file)
+
+    def __init__(self, args, inpath='', outpath=''):
+        self.args = args
+        self.in_path = inpath
+        self.out_path = outpath
+        self.in_file_name = os.path.split(inpath)[1]
+        self.out_file_name = os.path.split(outpath)[1]
+        self.in_lines = 0
+        self.out_lines = 0
+        self.line_changed = False
+        self.matches = 0
+        self.errors = 0
+        self.tracing = bool(args.trace)
+        self.stats = None       # ProcessStats when --stats is on
+        self.aggregator = None  # Aggregator when --group-by/--agg are on
+        self.memo = get_memo(args)
+        self.messages = None    # When a list, trace/echo output is buffered
+
+    def trace(self, msg):
+        if (self.args.trace):
+            if self.messages is not None:
+                self.messages.append((self.in_lines, msg))
+            else:
+                say(self.args, '%s[%03d]\t%s' % (self.in_file_name, self.in_lines, msg))
+
+    def echo(self, msg):
+        if self.messages is not None:
+            self.messages.append((None, msg))
+        else:
+            say(self.args, msg)
+
+    def flush_messages(self, messages, first_line_no=0):
+        for (line_no, msg) in messages:
+            if line_no is None:
+                say(self.args, msg)
+            else:
+                say(self.args, '%s[%03d]\t%s' % (self.in_file_name, first_line_no + line_no, msg))
+
+
+def split_url(url):
+    # (scheme, netloc, path, fragment, [(query key, value)]); an empty query
+    # item is skipped and a key without "=" gets an empty value
+    us = urlparse.urlsplit(url)
+    query = []
+    for q in us.query.split('&'):
+        if not q:
+            continue
+        kvp = q.split('=')
+        query.append((kvp[0], kvp[1] if len(kvp) > 1 else ''))
+    return (us.scheme, us.netloc, us.path, us.fragment, query)
+
+
+def process_path_command(json_line, path, command, ctx):
     if not json_line:
         return None
     c = command
 
     if c == 'key_expand':
         v = jtree_get(json_line, path)
-        internal_json = json.loads(v)
+        internal_json = memo_call(ctx, c, v, get_codec(ctx.args.codec)['loads'])
         jtree_set(json_line, path, internal_json)
     elif c == 'key_expand_url':
         v = jtree_get(json_line, path)
-        us = urlparse.urlsplit(v)
+        (scheme, netloc, url_path, fragment, query) = memo_call(ctx, c, v, split_url)
         jl = jtree_del(json_line, path)
-        jl = jtree_set(jl, path + ".scheme", us.scheme)
-        jl = jtree_set(jl, path + ".netloc", us.netloc)
-        jl = jtree_set(jl, path + ".path", us.path)
-        jl = jtree_set(jl, path + ".fragment", us.fragment)
-        queries = us.query.split('&')
-        for q in queries:
-            kvp = q.split('=')
-            k = kvp[0]
-            v = kvp[1]
+        jl = jtree_set(jl, path + ".scheme", scheme)
+        jl = jtree_set(jl, path + ".netloc", netloc)
+        jl = jtree_set(jl, path + ".path", url_path)
+        jl = jtree_set(jl, path + ".fragment", fragment)
+        for (k, v) in query:
             jl = jtree_set(jl, path + ".query." + k, v)
         json_line = jl
     elif c == 'key_unquote':
         v = jtree_get(json_line, path)
-        unquoted = urllib.unquote(v)
+        unquoted = memo_call(ctx, c, v, urllib.unquote)
         jtree_set(json_line, path, unquoted)
-    elif c == 'line_keep':
-        pass
     elif c == 'line_strip':
         json_line = None
-    elif c == 'key_keep':
-        pass
     elif c == 'key_strip':
         json_line = jtree_del(json_line, path)
     elif c == 'key_echo':
         v = jtree_get(json_line, path)
-        print(path + '=' + str(v))
+        ctx.echo(path + '=' + str(v))
     return json_line
 
 
-def process_line_command(json_line, command, selector_expr):
+def process_line_command(json_line, cmd, ctx):
     if not json_line:
         return None
+    command = cmd['command']
     if command == 'array_sort':
-        (path_selector, sort_key, oper) = split_key_value_operator(selector_expr)
-        array_paths = jtree_select(json_line, path_selector)
+        sort_key = cmd['sort_key']
+        array_paths = jtree_select(json_line, cmd)
+        if ctx.stats is not None:
+            ctx.matches = ctx.matches + len(array_paths)
         for p in reversed(array_paths):
             status = 'OK'
             try:
@@ -342,27 +1237,193 @@ def process_line_command(json_line, command, selector_expr):
                 if not isinstance(arr, list):
                     status = 'Error: path is not array'
                 else:
-                    if oper == ':' and sort_key:
+                    if sort_key:
                         sort_func = lambda x: x[sort_key]
                     else:
                         sort_func = lambda x: x
                     arr = sorted(arr, key=sort_func)
                     json_line = jtree_set(json_line, p, arr)
+                    ctx.line_changed = True
             except BaseException as e:
                 status = 'Error: %s' % (str(e))
-            trace_msg('\tMatch: %s (%s)' % (p, status))
+                if ctx.stats is not None:
+                    ctx.errors = ctx.errors + 1
+            if ctx.tracing:
+                ctx.trace('\tMatch: %s (%s)' % (p, status))
+    elif command == 'key_keep':
+        # The first key_keep of a run keeps the keys of the whole run
+        if cmd['keep_run']:
+            paths = []
+            for keep_cmd in cmd['keep_run']:
+                paths.extend(jtree_select(json_line, keep_cmd))
+            if ctx.stats is not None:
+                ctx.matches = ctx.matches + len(paths)
+            ctx.line_changed = True
+            json_line = jtree_project(json_line, paths)
+            if ctx.tracing:
+                for p in paths:
+                    ctx.trace('\tMatch: %s (OK)' % (p))
+    elif command == 'line_keep':
+        paths = jtree_select(json_line, cmd)
+        if ctx.stats is not None:
+            ctx.matches = ctx.matches + len(paths)
+        if not paths:
+            json_line = None
+        if ctx.tracing:
+            for p in paths:
+                ctx.trace('\tMatch: %s (OK)' % (p))
     else:
-        paths = jtree_select(json_line, selector_expr)
+        paths = jtree_select(json_line, cmd)
+        if paths:
+            if ctx.stats is not None:
+                ctx.matches = ctx.matches + len(paths)
+            if cmd['mutates']:
+                ctx.line_changed = True
         for p in reversed(paths):
             status = 'OK'
             try:
-                json_line = process_path_command(json_line, p, command)
+                json_line = process_path_command(json_line, p, command, ctx)
             except BaseException as e:
                 status = 'Error: %s' % (str(e))
-            trace_msg('\tMatch: %s (%s)' % (p, status))
+                if ctx.stats is not None:
+                    ctx.errors = ctx.errors + 1
+            if ctx.tracing:
+                ctx.trace('\tMatch: %s (%s)' % (p, status))
     return json_line
 
 
+# Commands that give the same result when adjacent ones run as one
+GROUPED_COMMANDS = [
+    'line_strip',
+    'key_strip',
+]
+
+
+def _groupable(cmd):
+    return cmd['command'] in GROUPED_COMMANDS and (cmd['segments'] is not None or cmd['filter_mode'] in ALTERNATION_PATTERNS)
+
+
+def group_commands(cmds):
+    # Runs of adjacent groupable commands of the same kind are matched with
+    # one walk: the first command of a run gets the run as its 'group' and a
+    # multi selector, the others an empty group. Returns cmds.
+    start = 0
+    while start < len(cmds):
+        end = start + 1
+        if _groupable(cmds[start]):
+            while end < len(cmds) and cmds[end]['command'] == cmds[start]['command'] and _groupable(cmds[end]):
+                end = end + 1
+        if end - start > 1:
+            group = cmds[start:end]
+            for cmd in group:
+                cmd['group'] = []
+            cmds[start]['group'] = group
+            cmds[start]['multi'] = compile_multi_selector(group)
+        start = end
+
+    # Adjacent key_keep commands keep their keys together
+    start = 0
+    while start < len(cmds):
+        end = start + 1
+        if cmds[start]['command'] == 'key_keep':
+            while end < len(cmds) and cmds[end]['command'] == 'key_keep':
+                end = end + 1
+            for cmd in cmds[start + 1:end]:
+                cmd['keep_run'] = []
+            cmds[start]['keep_run'] = cmds[start:end]
+        start = end
+
+    # When key_keep comes first only what it keeps needs to be parsed
+    if cmds and cmds[0]['command'] == 'key_keep':
+        segments = [cmd['segments'] for cmd in cmds[0]['keep_run']]
+        if not None in segments:
+            cmds[0]['pushdown'] = segments
+    return cmds
+
+
+def process_group_command(json_line, first_cmd, ctx):
+    # Same result as running the commands of the group one after the other
+    # (with --stats they do run one by one, so groups count no matches)
+    if not json_line:
+        return None
+    group = first_cmd['group']
+    found = jtree_multi_walk(json_line, first_cmd['multi'])
+
+    if first_cmd['command'] == 'line_strip':
+        for (cmd, cmd_found) in zip(group, found):
+            operator = cmd['operator']
+            if operator is None:
+                matched = bool(cmd_found)
+            else:
+                operand = cmd['operand']
+                matched = any([operator(m[3], operand) for m in _operand_nodes(json_line, cmd_found)])
+            if matched:
+                ctx.line_changed = True
+                return None
+        return json_line
+
+    # key_strip: deleting dict keys leaves the other paths as they are, but
+    # deleting array items shifts the ones after them
+    for cmd_found in found:
+        for (p, parent, k, v, r) in cmd_found:
+            if r != REACH_DICT or not p:
+                for cmd in group:
+                    json_line = process_line_command(json_line, cmd, ctx)
+                return json_line
+    deleted = []
+    for (cmd, cmd_found) in zip(group, found):
+        if not json_line:
+            return None
+        if deleted:
+            cmd_found = [m for m in cmd_found if not _under_paths(m[0], deleted)]
+        operator = cmd['operator']
+        if operator is None:
+            paths = [m[0] for m in cmd_found]
+        else:
+            operand = cmd['operand']
+            paths = [m[0] for m in _operand_nodes(json_line, cmd_found) if operator(m[3], operand)]
+        if paths:
+            ctx.line_changed = True
+        for p in reversed(paths):
+            try:
+                json_line = jtree_del(json_line, p)
+            except BaseException:
+                pass
+        deleted.extend(paths)
+    return json_line
+
+
+def _under_paths(p, paths):
+    for d in paths:
+        if p == d or p.startswith(d + '.'):
+            return True
+    return False
+
+
+def compile_command(cmd, filter_mode='wildpath', plan_cache_size=0):
+    compiled = compile_selector(cmd['selector'], filter_mode)
+    compiled.update(cmd)
+    compiled['group'] = None
+    compiled['keep_run'] = None
+    compiled['pushdown'] = None
+    # Literal segments are looked up directly, plans only pay off for wildcards
+    segments = compiled['segments']
+    if plan_cache_size > 0 and segments is not None:
+        if not all(isinstance(seg, str) for seg in segments):
+            compiled['plans'] = PlanCache(plan_cache_size)
+    if cmd['command'] == 'array_sort':
+        # The operand of "PATH:KEY" names the sort key, it does not filter paths
+        if compiled['operator'] is OPERATORS[':']:
+            compiled['sort_key'] = compiled['operand']
+        else:
+            compiled['sort_key'] = None
+        compiled['operator_name'] = None
+        compiled['operator'] = None
+        compiled['operand'] = None
+    compiled['mutates'] = not cmd['command'] in READONLY_COMMANDS
+    return compiled
+
+
 def build_commands_list(args):
     cmds = []
 
@@ -396,40 +1457,421 @@ def build_commands_list(args):
         if getattr(args, command):
             for selector_expr in getattr(args, command):
                 cmds.append({'command' : command, 'selector' : selector_expr})
-    return cmds
+    return group_commands([compile_command(cmd, plan_cache_size=args.plan_cache) for cmd in cmds])
 
 
-def process_line(json_line, cmds):
-    for (cmd_num, cmd) in enumerate(cmds):
+# Characters that always appear verbatim in a JSON text (no escaping needed)
+PREFILTER_SAFE = set(string.printable) - set('"\\/\t\n\r\x0b\x0c')
+
+# Operators whose operand must appear verbatim in the matched string value
+PREFILTER_OPERAND_OPERATORS = ['==', '@@']
+
+
+def _prefilter_safe(s):
+    return len(s) > 0 and PREFILTER_SAFE.issuperset(s)
+
+
+def command_needles(cmd):
+    # Substrings that must all appear in a raw line for cmd to match anything.
+    # Returns None when the selector can't be reduced to plain substrings.
+    segments = cmd['segments']
+    if segments is None:
+        return None
+    needles = []
+    for (idx, seg) in enumerate(segments):
+        if not isinstance(seg, str):
+            return None
+        if seg.isdigit():       # May be an array index that is never written out
+            continue
+        if not _prefilter_safe(seg):
+            return None
+        if idx == len(segments) - 1:
+            seg = seg + '"'
+        needles.append(seg)
+    if cmd['operator_name'] in PREFILTER_OPERAND_OPERATORS and _prefilter_safe(cmd['operand']):
+        needles.append(cmd['operand'])
+    return needles
+
+
+def build_prefilter(cmds):
+    # Returns (keeps, changes) or None. A line that misses the needles of a
+    # keep command (of every key of a -kk run) is dropped by it, unless a
+    # command before it may add them. Without keep commands, a line that
+    # misses a needle of every command is left untouched by all of them:
+    # commands that add content (key_expand etc.) only do so on a match.
+    keeps = []
+    changes = []
+    expanded = False
+    for cmd in cmds:
         command = cmd['command']
-        selector_expr = cmd['selector']
-        trace_msg('(%02d) %s(%s)' % (cmd_num, command, selector_expr))
-        json_line = process_line_command(json_line, command, selector_expr)
+        if command in KEEP_COMMANDS:
+            changes = None
+            run = [cmd] if command == 'line_keep' else cmd['keep_run']
+            if run and not expanded:
+                alternatives = [command_needles(keep_cmd) for keep_cmd in run]
+                if not None in alternatives:
+                    keeps.append(alternatives)
+        elif changes is not None:
+            needles = command_needles(cmd)
+            if needles is None:
+                changes = None
+            else:
+                changes.append(needles)
+        if command in EXPANDING_COMMANDS:
+            expanded = True
+    if not keeps and changes is None:
+        return None
+    return (keeps, changes)
+
+
+def _has_needles(needles, line):
+    for n in needles:
+        if not n in line:
+            return False
+    return True
+
+
+def prefilter_keeps(prefilter, line):
+    # False if a keep command is sure to drop the line
+    for alternatives in prefilter[0]:
+        for needles in alternatives:
+            if _has_needles(needles, line):
+                break
+        else:
+            return False
+    return True
+
+
+def prefilter_match(prefilter, line):
+    # False if no command can change the line
+    if prefilter[1] is None:
+        return True
+    for needles in prefilter[1]:
+        if _has_needles(needles, line):
+            return True
+    return False
+
+
+def process_line(json_line, cmds, ctx):
+    if ctx.tracing:
+        for (cmd_num, cmd) in enumerate(cmds):
+            ctx.trace('(%02d) %s(%s)' % (cmd_num, cmd['command'], cmd['selector']))
+            json_line = process_line_command(json_line, cmd, ctx)
+        return json_line
+    for cmd in cmds:
+        group = cmd['group']
+        if group is None:
+            json_line = process_line_command(json_line, cmd, ctx)
+        elif group:
+            json_line = process_group_command(json_line, cmd, ctx)
+        # else the command is run by the first one of its group
+    return json_line
+
+
+def process_line_stats(json_line, cmds, ctx):
+    # process_line, also accounting each command's matches, errors and time
+    stats = ctx.stats
+    for (cmd_num, cmd) in enumerate(cmds):
+        if ctx.tracing:
+            ctx.trace('(%02d) %s(%s)' % (cmd_num, cmd['command'], cmd['selector']))
+        if not json_line:
+            continue
+        cmd_stats = stats.commands[cmd_num]
+        matches = ctx.matches
+        errors = ctx.errors
+        start = time.time()
+        json_line = process_line_command(json_line, cmd, ctx)
+        cmd_stats['seconds'] = cmd_stats['seconds'] + (time.time() - start)
+        cmd_stats['invocations'] = cmd_stats['invocations'] + 1
+        cmd_stats['matches'] = cmd_stats['matches'] + (ctx.matches - matches)
+        cmd_stats['errors'] = cmd_stats['errors'] + (ctx.errors - errors)
     return json_line
 
 
+# For lazy_loads: whitespace, a JSON string, a number or literal, and a whole
+# value with containers nested up to LAZY_SKIP_DEPTH deep, all following the
+# JSON grammar (as strict as json.loads), so that skipped values are checked
+JSON_WS_PATTERN = r'[ \t\n\r]*'
+JSON_WS_RE = re.compile(JSON_WS_PATTERN)
+JSON_STRING_PATTERN = r'"[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*"'
+JSON_STRING_RE = re.compile(JSON_STRING_PATTERN)
+JSON_SCALAR_PATTERN = r'(?:-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null|NaN|-?Infinity)'
+JSON_SCALAR_RE = re.compile(JSON_SCALAR_PATTERN)
+# After an item: a comma and another item, or the end of the container
+JSON_NEXT_PATTERN = r'(?:,' + JSON_WS_PATTERN + r'(?![\]}])|(?=[\]}]))'
+LAZY_SKIP_DEPTH = 4
+
+
+def _value_pattern(depth):
+    # Matches a value with objects and arrays nested at most depth levels deep
+    value = '(?:' + JSON_STRING_PATTERN + '|' + JSON_SCALAR_PATTERN + ')'
+    for level in range(depth):
+        item = value + JSON_WS_PATTERN + JSON_NEXT_PATTERN
+        member = JSON_STRING_PATTERN + JSON_WS_PATTERN + ':' + JSON_WS_PATTERN + item
+        value = ('(?:' + JSON_STRING_PATTERN + '|' + JSON_SCALAR_PATTERN +
+            r'|\{' + JSON_WS_PATTERN + '(?:' + member + r')*\}' +
+            r'|\[' + JSON_WS_PATTERN + '(?:' + item + r')*\])')
+    return value
+
+# Skips most values in a single match, deeper ones level by level
+JSON_VALUE_RE = re.compile(_value_pattern(LAZY_SKIP_DEPTH))
+
+
+def _lazy_skip(s, idx):
+    # Returns the end of the JSON value at idx without decoding it, raises
+    # ValueError if it isn't valid JSON
+    m = JSON_VALUE_RE.match(s, idx)
+    if m is not None:
+        return m.end()
+    c = s[idx]
+    if c == '{':
+        close = '}'
+    elif c == '[':
+        close = ']'
+    else:
+        raise ValueError('Expecting value at %d' % (idx))
+    idx = JSON_WS_RE.match(s, idx + 1).end()
+    if s[idx] == close:
+        return idx + 1
+    while True:
+        if close == '}':
+            m = JSON_STRING_RE.match(s, idx)
+            if m is None:
+                raise ValueError('Expecting property name at %d' % (idx))
+            idx = JSON_WS_RE.match(s, m.end()).end()
+            if s[idx] != ':':
+                raise ValueError('Expecting : delimiter at %d' % (idx))
+            idx = JSON_WS_RE.match(s, idx + 1).end()
+        idx = JSON_WS_RE.match(s, _lazy_skip(s, idx)).end()
+        c = s[idx]
+        if c == close:
+            return idx + 1
+        if c != ',':
+            raise ValueError('Expecting , delimiter at %d' % (idx))
+        idx = JSON_WS_RE.match(s, idx + 1).end()
+
+
+def _lazy_decode(s, idx, loads):
+    end = _lazy_skip(s, idx)
+    return (loads(s[idx:end]), end)
+
+
+def _lazy_value(s, idx, states, loads):
+    # Decodes the value at idx keeping only what the (segments, depth) states
+    # can still match below it. Skipped array items are kept as None, so the
+    # index of the others doesn't change.
+    for (segments, depth) in states:
+        if depth == len(segments):
+            return _lazy_decode(s, idx, loads)
+    c = s[idx]
+    if c == '{':
+        obj = {}
+        idx = JSON_WS_RE.match(s, idx + 1).end()
+        if s[idx] == '}':
+            return (obj, idx + 1)
+        while True:
+            if s[idx] != '"':
+                raise ValueError('Expecting property name at %d' % (idx))
+            (k, idx) = json.decoder.scanstring(s, idx + 1)
+            idx = JSON_WS_RE.match(s, idx).end()
+            if s[idx] != ':':
+                raise ValueError('Expecting : delimiter at %d' % (idx))
+            idx = JSON_WS_RE.match(s, idx + 1).end()
+            if '.' in k:
+                # May match several segments at once, keep it whole
+                (obj[k], idx) = _lazy_decode(s, idx, loads)
+            else:
+                child_states = [(segments, depth + 1) for (segments, depth) in states if _seg_match(segments[depth], k)]
+                if child_states:
+                    (obj[k], idx) = _lazy_value(s, idx, child_states, loads)
+                else:
+                    idx = _lazy_skip(s, idx)
+            idx = JSON_WS_RE.match(s, idx).end()
+            c = s[idx]
+            idx = JSON_WS_RE.match(s, idx + 1).end()
+            if c == '}':
+                return (obj, idx)
+            if c != ',':
+                raise ValueError('Expecting , delimiter at %d' % (idx))
+    if c == '[':
+        arr = []
+        idx = JSON_WS_RE.match(s, idx + 1).end()
+        if s[idx] == ']':
+            return (arr, idx + 1)
+        while True:
+            key = str(len(arr))
+            child_states = [(segments, depth + 1) for (segments, depth) in states if _seg_match(segments[depth], key)]
+            if child_states:
+                (v, idx) = _lazy_value(s, idx, child_states, loads)
+            else:
+                v = None
+                idx = _lazy_skip(s, idx)
+            arr.append(v)
+            idx = JSON_WS_RE.match(s, idx).end()
+            c = s[idx]
+            idx = JSON_WS_RE.match(s, idx + 1).end()
+            if c == ']':
+                return (arr, idx)
+            if c != ',':
+                raise ValueError('Expecting , delimiter at %d' % (idx))
+    return _lazy_decode(s, idx, loads)
+
+
+def lazy_loads(s, segments_list, loads):
+    # Parses a JSON text building only the parts that the selectors split into
+    # segments_list may match (with loads); everything else is checked but
+    # skipped over unparsed. Texts it can't take are parsed whole by loads,
+    # which raises the same errors as without the projection.
+    try:
+        s.decode('utf-8')       # Skipped strings are bytes that must decode too
+        idx = JSON_WS_RE.match(s).end()
+        (obj, idx) = _lazy_value(s, idx, [(segments, 0) for segments in segments_list], loads)
+        if JSON_WS_RE.match(s, idx).end() == len(s):
+            return obj
+    except (ValueError, IndexError):
+        pass
+    return loads(s)
+
+
 def to_json_line(line, args):
-    return json.loads(line)
+    return get_codec(args.codec)['loads'](line)
+
+
+def parse_line(line, cmds, args):
+    if cmds and cmds[0]['pushdown'] is not None:
+        return lazy_loads(line, cmds[0]['pushdown'], get_codec(args.codec)['loads'])
+    return to_json_line(line, args)
+
+
+def process_raw_line(line, cmds, prefilter, ctx):
+    # Returns the output text for an input line, None if the line is stripped
+    # With -b none, lines no command changed are written out byte for byte
+    args = ctx.args
+    if prefilter is not None:
+        if not prefilter_keeps(prefilter, line):
+            return None
+        if not prefilter_match(prefilter, line):
+            if args.beautify == 'none':
+                return line.rstrip('\r\n')
+            return output_line(to_json_line(line, args), args)
+    ctx.line_changed = False
+    json_line = parse_line(line, cmds, args)
+    json_line = process_line(json_line, cmds, ctx)
+    if json_line:
+        if args.beautify == 'none' and not ctx.line_changed:
+            return line.rstrip('\r\n')
+        return output_line(json_line, args)
+    return None
+
+
+def process_raw_line_stats(line, cmds, prefilter, ctx):
+    # process_raw_line, also timing the parse, transform and serialize phases
+    args = ctx.args
+    stats = ctx.stats
+    stats.in_lines = stats.in_lines + 1
+    t0 = time.time()
+    if prefilter is not None and not prefilter_keeps(prefilter, line):
+        stats.skipped = stats.skipped + 1
+        return None
+    if prefilter is not None and not prefilter_match(prefilter, line):
+        stats.skipped = stats.skipped + 1
+        stats.out_lines = stats.out_lines + 1
+        if args.beautify == 'none':
+            return line.rstrip('\r\n')
+        json_line = to_json_line(line, args)
+        t1 = time.time()
+        oline = output_line(json_line, args)
+        t2 = time.time()
+        stats.phases['parse'] = stats.phases['parse'] + (t1 - t0)
+        stats.phases['serialize'] = stats.phases['serialize'] + (t2 - t1)
+        stats.maybe_report(t2)
+        return oline
+
+    ctx.line_changed = False
+    json_line = parse_line(line, cmds, args)
+    t1 = time.time()
+    json_line = process_line_stats(json_line, cmds, ctx)
+    t2 = time.time()
+    oline = None
+    if json_line:
+        stats.out_lines = stats.out_lines + 1
+        if args.beautify == 'none' and not ctx.line_changed:
+            oline = line.rstrip('\r\n')
+        else:
+            oline = output_line(json_line, args)
+    t3 = time.time()
+    stats.phases['parse'] = stats.phases['parse'] + (t1 - t0)
+    stats.phases['transform'] = stats.phases['transform'] + (t2 - t1)
+    stats.phases['serialize'] = stats.phases['serialize'] + (t3 - t2)
+    stats.maybe_report(t3)
+    return oline
+
+
+def line_processor(ctx):
+    # The instrumented variant is picked once, the plain one does no accounting
+    if ctx.stats is not None:
+        return process_raw_line_stats
+    return process_raw_line
+
+
+ISO_TIME_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?)?'
+    r'\s*(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def parse_time(val):
+    # Epoch seconds for an epoch number (or numeric string) or an ISO-8601
+    # string without zone taken as UTC; None for anything else
+    if isinstance(val, bool):
+        return None
+    if isinstance(val, basestring):
+        val = val.strip()
+        try:
+            val = float(val)
+        except ValueError:
+            m = ISO_TIME_RE.match(val)
+            if m is None:
+                return None
+            (year, month, day, hour, minute, sec, frac, zone) = m.groups()
+            try:
+                t = calendar.timegm((int(year), int(month), int(day),
+                    int(hour or 0), int(minute or 0), int(sec or 0), 0, 0, 0))
+            except ValueError:
+                return None
+            if frac:
+                t = t + float(frac)
+            if zone and zone != 'Z':
+                offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+                t = t - offset if zone[0] == '+' else t + offset
+            return t
+    if isinstance(val, (int, long, float)):
+        if abs(val) > EPOCH_MS_THRESHOLD:
+            return val / 1000.0
+        return val
+    return None
+
+
+def parse_time_arg(s):
+    if s is None:
+        return None
+    t = parse_time(s)
+    if t is None:
+        raise SyntaxError('error: can not parse time "%s" (expected ISO-8601 or epoch)' % (s))
+    return t
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(
         description='Filter a JSON logfile',
         fromfile_prefix_chars='@')
-    '''
     parser.add_argument('-kk', '--key_keep',
         metavar='KEY', type=str, action='append', dest='key_keep',
-        help='keeps only the specified key in all log lines',)
+        help='keeps only the specified key in all log lines (adjacent -kk keys are kept together); '
+            'like other emptied lines, lines without any kept key are dropped',)
     parser.add_argument('-lk', '--line_keep',
         metavar='KEY', type=str, action='append', dest='line_keep',
         help='keeps only log lines that contain the specified key',)
-    parser.add_argument('-m',
-        dest='merge', metavar='KEYS', type=str, nargs=1,
-        help='NOT IMPLEMENTED: merges all given (sorted) JSON files into a single log sorted according to KEY',)
-    parser.add_argument('-s',
-        dest='sort', metavar='KEYS', type=str, nargs=1,
-        help='NOT IMPLEMENTED: sorts output file according to KEY',)
-    '''
     parser.add_argument('-ks', '--key_strip',
         metavar='KEY', type=str, action='append', dest='key_strip',
         help='strips specified key from all log lines',)
@@ -451,6 +1893,33 @@ def parse_args(argv):
     parser.add_argument('-asort', '--array_sort',
         metavar='KEY', type=str, action='append', dest='array_sort',
         help='sorts the array containing the key under the specified path',)
+    parser.add_argument('-m',
+        dest='merge', metavar='KEYS', type=str, nargs=1,
+        help='merges all given JSON files, each already sorted by the comma separated KEYS, into a single log sorted by KEYS',)
+    parser.add_argument('-s',
+        dest='sort', metavar='KEYS', type=str, nargs=1,
+        help='sorts each output file according to the comma separated KEYS (-j is ignored)',)
+    parser.add_argument('--since', dest='since',
+        type=str, metavar='TIME',
+        help='keeps only log lines from TIME on (ISO-8601 or epoch), seeking to it in plain input files sorted by time',)
+    parser.add_argument('--until', dest='until',
+        type=str, metavar='TIME',
+        help='keeps only log lines before TIME (ISO-8601 or epoch)',)
+    parser.add_argument('--time-key', dest='time_key',
+        default=DEFAULT_TIME_KEY, type=str, metavar='KEY',
+        help='key holding the timestamp of each log line, for --since/--until (default: %s)' % (DEFAULT_TIME_KEY),)
+    parser.add_argument('--index', dest='index',
+        type=str, metavar='KEYS', nargs=1,
+        help='builds (or refreshes) a sidecar index ("%s") of the values of the comma separated KEYS of each input file, and exits; -lk PATH==VALUE commands that come first then only read the lines the index lists' % (INDEX_SUFFIX),)
+    parser.add_argument('--group-by', dest='group_by',
+        type=str, metavar='KEYS', nargs=1,
+        help='aggregates the (processed) log lines by the values of the comma separated KEYS and prints a table of the --agg metrics instead of writing output files; KEY/SECONDS groups the times in KEY into buckets of SECONDS',)
+    parser.add_argument('--agg', dest='agg',
+        type=str, metavar='METRIC', action='append',
+        help='metric to aggregate per --group-by key: count, count:KEY, sum:KEY, min:KEY, max:KEY, avg:KEY, pNN:KEY (percentile, e.g. p95) or distinct:KEY (approximate) (default: count)',)
+    parser.add_argument('--sort-memory', dest='sort_memory',
+        default=DEFAULT_SORT_MEMORY, type=int, metavar='BYTES',
+        help='approximate memory used for sorting (with -s) before spilling sorted runs to temporary files',)
 
     parser.add_argument('-v',
         action='count', dest='verbose',
@@ -463,16 +1932,52 @@ def parse_args(argv):
         help='loads commands from specified file by order (before all argument commands)',)
     parser.add_argument('infiles',
         nargs='*', metavar='IN',
-        help='input files',)
+        help='input files ("-" for stdin, .gz/.bz2/.xz are decompressed)',)
     parser.add_argument('-o', dest='outfiles',
         nargs='*', metavar='OUT',
-        help='output file',)
+        help='output file ("-" for stdout, .gz/.bz2/.xz are compressed)',)
     parser.add_argument('-os', dest='outsuffix',
         default='.x.json', type=str, metavar='SUFFIX',
         help='suffix to be appended to input file name(s)',)
     parser.add_argument('-b',
         dest='beautify', default='array', choices=BEAUTIFY_CHOICES,
         help='beautify JSON output lines',)
+    parser.add_argument('--codec', dest='codec',
+        default=DEFAULT_CODEC, choices=CODEC_CHOICES,
+        help='JSON library used to parse and write lines (default: the fastest installed parser, stdlib json output)',)
+    parser.add_argument('-j', dest='jobs',
+        default=1, type=int, metavar='N',
+        help='process each input file in chunks using N worker processes',)
+    parser.add_argument('--chunk-size', dest='chunk_size',
+        default=DEFAULT_CHUNK_SIZE, type=int, metavar='BYTES',
+        help='approximate size of the input chunks handed to each worker (with -j)',)
+    parser.add_argument('--prefilter', dest='prefilter',
+        action='store_true',
+        help='skip commands (and JSON parsing with -b none) for lines that lack the literal keys/values they select, and drop lines that lack those of a -lk/-kk without parsing them',)
+    parser.add_argument('-jf', dest='file_jobs',
+        default=1, type=int, metavar='N',
+        help='process up to N input files concurrently (each file on a single worker, -j is ignored)',)
+    parser.add_argument('--stats', dest='stats',
+        nargs='?', const=STDIO_PATH, metavar='FILE',
+        help='append a JSON report of per-command and per-phase counters and timings to FILE (default: stderr) on exit',)
+    parser.add_argument('--stats-interval', dest='stats_interval',
+        default=0, type=float, metavar='SECONDS',
+        help='also report --stats every SECONDS while running',)
+    parser.add_argument('--memo-size', dest='memo_size',
+        default=DEFAULT_MEMO_SIZE, type=int, metavar='N',
+        help='cache the results of the last N distinct key_expand/key_expand_url/key_unquote values (0 disables)',)
+    parser.add_argument('--plan-cache', dest='plan_cache',
+        default=DEFAULT_PLAN_CACHE_SIZE, type=int, metavar='N',
+        help='remember the matching paths of wildcard selectors for up to N line shapes per command (0 disables)',)
+    parser.add_argument('--follow', dest='follow',
+        action='store_true',
+        help='keep reading lines appended to the input files (across log rotation), until interrupted',)
+    parser.add_argument('--follow-interval', dest='follow_interval',
+        default=DEFAULT_FOLLOW_INTERVAL, type=float, metavar='SECONDS',
+        help='how often to poll for new lines and save a checkpoint (with --follow)',)
+    parser.add_argument('--checkpoint', dest='checkpoints',
+        type=str, metavar='PATH', action='append',
+        help='checkpoint file per input file, for resuming --follow (default: output file + "%s")' % (CHECKPOINT_SUFFIX),)
 
     args = parser.parse_args()
 
@@ -482,88 +1987,869 @@ def parse_args(argv):
     if len(args.infiles) == 0:
         raise SyntaxError('error: supply at least one input file')
 
-    args.outfiles = expand_file_paths(args.outfiles)
-
-    if len(args.outfiles) == 0:
-        for inpath in args.infiles:
-            outpath = inpath + args.outsuffix
-            args.outfiles.append(outpath)
+    # Output files usually don't exist yet, so they aren't globbed
+    if args.outfiles is None:
+        args.outfiles = []
 
-    '''
     if args.merge:
         args.merge = string.split(args.merge[0], ',')
-    if args.sort:
-        args.sort = string.split(args.sort[0], ',')
-    if (args.merge):
         if len(args.outfiles) != 1:
             raise SyntaxError('error: merge operation requires only one output file (%d given)' % (len(args.outfiles)))
         if len(args.infiles) < 2:
             raise SyntaxError('error: merge operation requires at least two input files (%d given)' % (len(args.infiles)))
-    '''
-    if len(args.infiles) != len(args.outfiles):
+        if args.follow or args.file_jobs > 1:
+            raise SyntaxError('error: merge operation can not be combined with --follow or -jf')
+    elif len(args.outfiles) == 0:
+        for inpath in args.infiles:
+            outpath = output_path(inpath, args.outsuffix)
+            args.outfiles.append(outpath)
+    elif args.outfiles == [STDIO_PATH]:
+        args.outfiles = [STDIO_PATH for inpath in args.infiles]
+
+    if args.sort:
+        args.sort = string.split(args.sort[0], ',')
+        if args.merge or args.follow:
+            raise SyntaxError('error: sort operation can not be combined with -m or --follow')
+    if args.index:
+        args.index = string.split(args.index[0], ',')
+        for path in args.infiles:
+            if not is_plain_file(path):
+                raise SyntaxError('error: --index requires plain input files (got %s)' % (path))
+
+    args.aggregate = bool(args.group_by or args.agg)
+    if args.aggregate:
+        if args.merge or args.sort or args.follow:
+            raise SyntaxError('error: --group-by/--agg can not be combined with -m, -s or --follow')
+        args.group_by = [parse_group_key(spec) for spec in string.split(args.group_by[0], ',')] if args.group_by else []
+        args.agg = [parse_metric(spec) for spec in args.agg or ['count']]
+
+    args.time_range = None
+    if args.since is not None or args.until is not None:
+        if args.follow:
+            raise SyntaxError('error: --since/--until can not be combined with --follow')
+        args.time_range = (parse_time_arg(args.since), parse_time_arg(args.until))
+
+    try:
+        get_codec(args.codec)
+    except ImportError:
+        raise SyntaxError('error: codec %s is not installed' % (args.codec))
+
+    if len(args.infiles) != len(args.outfiles) and not args.merge:
         raise SyntaxError('error: must supply equal amounts of input files and output files (given %d input, %d output' % (len(args.infiles), len(args.outfiles)))
 
+    if args.outfiles.count(STDIO_PATH) > 1 and args.beautify in ['array', 'dict'] and not args.aggregate:
+        raise SyntaxError('error: can not write several input files to stdout as one JSON %s (use -b none or -m)' % (args.beautify))
+
+    if args.file_jobs > 1 and STDIO_PATH in args.outfiles:
+        raise SyntaxError('error: can not write to stdout when processing files concurrently (-jf)')
+
+    if args.follow:
+        for path in args.infiles + args.outfiles:
+            if not is_plain_file(path):
+                raise SyntaxError('error: --follow requires plain input and output files (got %s)' % (path))
+        if len(args.infiles) > max(args.file_jobs, 1):
+            raise SyntaxError('error: --follow needs -jf %d to follow %d files' % (len(args.infiles), len(args.infiles)))
+        if not args.checkpoints:
+            args.checkpoints = [outpath + CHECKPOINT_SUFFIX for outpath in args.outfiles]
+        if len(args.checkpoints) != len(args.infiles):
+            raise SyntaxError('error: must supply a checkpoint file for each input file')
+
     if (args.verbose >= 2):
-        print('Running with arguments: ' + str(args))
+        say(args, 'Running with arguments: ' + str(args))
         for f in args.cmdfiles:
-            print('Command File: ' + str(f))
+            say(args, 'Command File: ' + str(f))
         for f in args.infiles:
-            print('Input File: ' + str(f))
+            say(args, 'Input File: ' + str(f))
         for f in args.outfiles:
-            print('Output File: ' + str(f))
+            say(args, 'Output File: ' + str(f))
 
     return args
 
 
-def process_one_log(inpath, outpath, cmds):
-    global in_lines
-    global out_lines
-    global in_file_name
-    global out_file_name
-    global args
+def raw_commands(cmds):
+    return [{'command': cmd['command'], 'selector': cmd['selector']} for cmd in cmds]
+
+
+def init_worker(worker_args, worker_cmds):
+    global pool_args
+    global pool_cmds
+    pool_args = worker_args
+    pool_cmds = group_commands([compile_command(cmd, plan_cache_size=worker_args.plan_cache) for cmd in worker_cmds])
+
+
+def chunk_tasks(ctx):
+    # Returns (file to close or None, process_chunk tasks for the file)
+    args = ctx.args
+    if is_plain_file(ctx.in_path):
+        return (None, [(ctx.in_path, start, end, None) for (start, end) in find_chunks(ctx.in_path, args.chunk_size)])
+    # Streams can't be split by offset: the parent reads line batches
+    infile = open_input(ctx.in_path, IO_BUFFER_SIZE)
+    return (infile, ((ctx.in_path, None, None, batch) for batch in read_line_batches(infile, args.chunk_size)))
+
+
+def process_chunk(task):
+    global pool_args
+    global pool_cmds
+
+    # Either a byte range of a plain file or a batch of lines read by the parent
+    (inpath, start, end, lines) = task
+    if lines is None:
+        with open(inpath, 'r') as infile:
+            infile.seek(start)
+            lines = infile.read(end - start).split('\n')
+        if lines[-1] == '':
+            lines.pop()
+
+    # Line numbers are relative to the chunk, the parent adds the offset
+    ctx = LogContext(pool_args, inpath)
+    ctx.messages = []
+    if pool_args.stats:
+        ctx.stats = ProcessStats(pool_cmds, memo=get_memo(pool_args))
+    prefilter = None
+    if pool_args.prefilter:
+        prefilter = build_prefilter(pool_cmds)
+    if pool_args.aggregate:
+        # The outputs are the chunk's aggregated groups instead of lines
+        ctx.aggregator = Aggregator(pool_args.group_by, pool_args.agg)
+        for l in lines:
+            aggregate_line(l, pool_cmds, prefilter, ctx)
+            ctx.in_lines = ctx.in_lines + 1
+        stats = None
+        if ctx.stats is not None:
+            ctx.stats.in_lines = ctx.in_lines
+            ctx.stats.out_lines = ctx.out_lines
+            stats = ctx.stats.to_dict()
+        return (ctx.aggregator.to_dict(), ctx.in_lines, ctx.messages, stats)
+    process = line_processor(ctx)
+    outputs = []
+    for l in lines:
+        oline = process(l, pool_cmds, prefilter, ctx)
+        if oline is not None:
+            outputs.append((ctx.in_lines, oline))
+            ctx.out_lines = ctx.out_lines + 1
+        ctx.in_lines = ctx.in_lines + 1
+    stats = None
+    if ctx.stats is not None:
+        stats = ctx.stats.to_dict()
+    return (outputs, ctx.in_lines, ctx.messages, stats)
+
+
+def process_file_job(task):
+    global pool_args
+    global pool_cmds
+
+    (inpath, outpath) = task
+    ctx = LogContext(pool_args, inpath, outpath)
+    if not pool_args.follow:
+        ctx.messages = []
+    if pool_args.stats:
+        ctx.stats = ProcessStats(pool_cmds, memo=get_memo(pool_args))
+    if pool_args.aggregate:
+        ctx.aggregator = Aggregator(pool_args.group_by, pool_args.agg)
+    process_one_log(ctx, pool_cmds)
+    stats = None
+    if ctx.stats is not None:
+        stats = ctx.stats.to_dict()
+    groups = None
+    if ctx.aggregator is not None:
+        groups = ctx.aggregator.to_dict()
+    return (inpath, outpath, ctx.in_lines, ctx.out_lines, ctx.messages, stats, groups)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    # Written aside and renamed over, so a crash never leaves half a checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def find_rotated(inpath, inode):
+    # The file next to inpath whose name starts with it (inpath.1 etc.) that
+    # still is inode, or None
+    (dirname, basename) = os.path.split(inpath)
+    for name in sorted(os.listdir(dirname or '.')):
+        if not name.startswith(basename) or name == basename:
+            continue
+        path = os.path.join(dirname, name)
+        try:
+            if os.stat(path).st_ino == inode:
+                return path
+        except OSError:
+            pass
+    return None
+
+
+def follow_one_log(ctx, cmds, checkpoint_path):
+    # Processes a growing log until SIGINT/SIGTERM. After each burst of lines
+    # the output is framed, synced and the input position is checkpointed, so a
+    # restart resumes exactly there (in the rotated file first, if the log was
+    # rotated meanwhile); lines written after the last checkpoint are truncated
+    # from the output and processed again.
+    args = ctx.args
+    stop = []
+
+    def request_stop(signum, frame):
+        stop.append(signum)
+
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, request_stop)
+
+    prefilter = None
+    if args.prefilter:
+        prefilter = build_prefilter(cmds)
+    process = line_processor(ctx)
+
+    def drain(f):
+        # Processes the rest of a file that won't grow anymore (a last line
+        # without a newline is complete)
+        for l in iter(f.readline, ''):
+            oline = process(l, cmds, prefilter, ctx)
+            if oline is not None:
+                writer.write(oline, ctx.in_lines)
+                ctx.out_lines = ctx.out_lines + 1
+            ctx.in_lines = ctx.in_lines + 1
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    infile = None
+    while infile is None and not stop:
+        try:
+            infile = open(ctx.in_path, 'r')
+        except IOError:
+            time.sleep(args.follow_interval)
+    if infile is None:
+        return (ctx.in_lines, ctx.out_lines)
+    inode = os.fstat(infile.fileno()).st_ino
+
+    if checkpoint is not None and os.path.exists(ctx.out_path):
+        outfile = open(ctx.out_path, 'r+')
+        outfile.seek(checkpoint['out_offset'])
+        outfile.truncate()
+        ctx.in_lines = checkpoint['in_lines']
+        ctx.out_lines = checkpoint['out_lines']
+        offset = 0
+        writer = OutputWriter(outfile, args.beautify)
+        writer.out_lines = ctx.out_lines
+        if checkpoint['inode'] == inode:
+            if checkpoint['offset'] <= os.fstat(infile.fileno()).st_size:
+                offset = checkpoint['offset']
+        else:
+            # Rotated while we were down: finish the old file, then start on
+            # the new one
+            rotated_path = find_rotated(ctx.in_path, checkpoint['inode'])
+            if rotated_path is not None:
+                with open(rotated_path, 'r') as rotated:
+                    rotated.seek(checkpoint['offset'])
+                    drain(rotated)
+        infile.seek(offset)
+    else:
+        outfile = open(ctx.out_path, 'w')
+        ctx.in_lines = 0
+        ctx.out_lines = 0
+        offset = 0
+        writer = OutputWriter(outfile, args.beautify)
+        writer.begin()
+
+    committed_lines = None
+    last_commit = 0
+    while not stop:
+        l = infile.readline()
+        if l.endswith('\n'):
+            oline = process(l, cmds, prefilter, ctx)
+            if oline is not None:
+                writer.write(oline, ctx.in_lines)
+                ctx.out_lines = ctx.out_lines + 1
+            ctx.in_lines = ctx.in_lines + 1
+            offset = offset + len(l)
+            if time.time() - last_commit < args.follow_interval:
+                continue
+
+        # Idle (or busy for a whole interval): make what we have durable
+        if committed_lines != ctx.in_lines:
+            save_checkpoint(checkpoint_path, {
+                'inode': inode,
+                'offset': offset,
+                'in_lines': ctx.in_lines,
+                'out_lines': ctx.out_lines,
+                'out_offset': writer.commit(),
+            })
+            committed_lines = ctx.in_lines
+            last_commit = time.time()
+        if l.endswith('\n'):
+            continue
+
+        # At the end of the file, possibly in the middle of a line being written
+        infile.seek(offset)
+        try:
+            st = os.stat(ctx.in_path)
+        except OSError:
+            st = None
+        if st is not None and st.st_ino != inode:
+            # Rotated: drain the old file and move on to the new one
+            drain(infile)
+            infile.close()
+            infile = open(ctx.in_path, 'r')
+            inode = os.fstat(infile.fileno()).st_ino
+            offset = 0
+            committed_lines = None
+            continue
+        if st is not None and st.st_size < offset:
+            # Truncated in place (copytruncate rotation)
+            infile.seek(0)
+            offset = 0
+            committed_lines = None
+            continue
+        time.sleep(args.follow_interval)
+
+    save_checkpoint(checkpoint_path, {
+        'inode': inode,
+        'offset': offset,
+        'in_lines': ctx.in_lines,
+        'out_lines': ctx.out_lines,
+        'out_offset': writer.commit(),
+    })
+    infile.close()
+    outfile.close()
+    return (ctx.in_lines, ctx.out_lines)
+
+
+def sort_one_log(ctx, cmds):
+    # External merge sort by args.sort: (key, line number, output line) records
+    # are collected up to --sort-memory, spilled as sorted runs and merged back.
+    # The line number keeps equal keys in input order (and labels -b dict).
+    args = ctx.args
+    transform = process_line
+    if ctx.stats is not None:
+        transform = process_line_stats
+
+    ctx.in_lines = 0
+    ctx.out_lines = 0
+    runs = []
+    run = []
+    run_size = 0
+    offsets = index_offsets(ctx.in_path, cmds)
+    (infile, lines) = open_lines(args, ctx.in_path, offsets, args.beautify == 'dict')
+    for (line_no, l) in lines:
+        ctx.line_changed = False
+        json_line = transform(parse_line(l, cmds, args), cmds, ctx)
+        if json_line:
+            if args.beautify == 'none' and not ctx.line_changed:
+                oline = l.rstrip('\r\n')
+            else:
+                oline = output_line(json_line, args)
+            run.append((line_sort_key(json_line, args.sort), line_no, oline))
+            run_size = run_size + len(oline) + SORT_RECORD_OVERHEAD
+            if run_size >= args.sort_memory:
+                runs.append(spill_run(run, 'xjson-sort-'))
+                run = []
+                run_size = 0
+        ctx.in_lines = ctx.in_lines + 1
+    infile.close()
+
+    if runs:
+        if run:
+            runs.append(spill_run(run, 'xjson-sort-'))
+        run = None
+        records = heapq.merge(*[read_run(f) for f in runs])
+    else:
+        run.sort()
+        records = run
+
+    outfile = open_output(ctx.out_path, IO_BUFFER_SIZE)
+    writer = OutputWriter(outfile, args.beautify)
+    writer.begin()
+    for (key, line_no, oline) in records:
+        writer.write(oline, line_no)
+        ctx.out_lines = ctx.out_lines + 1
+    writer.end()
+    outfile.close()
+    for f in runs:
+        f.close()
+
+    if ctx.stats is not None:
+        ctx.stats.in_lines = ctx.stats.in_lines + ctx.in_lines
+        ctx.stats.out_lines = ctx.stats.out_lines + ctx.out_lines
+    return (ctx.in_lines, ctx.out_lines)
+
+
+def aggregate_line(line, cmds, prefilter, ctx):
+    # Feeds a processed line to ctx.aggregator (lines the prefilter rules out
+    # are aggregated as they are, unless a keep command drops them)
+    args = ctx.args
+    if prefilter is not None and not prefilter_keeps(prefilter, line):
+        return
+    if prefilter is not None and not prefilter_match(prefilter, line):
+        json_line = to_json_line(line, args)
+    else:
+        ctx.line_changed = False
+        json_line = parse_line(line, cmds, args)
+        if ctx.stats is not None:
+            json_line = process_line_stats(json_line, cmds, ctx)
+        else:
+            json_line = process_line(json_line, cmds, ctx)
+    if json_line:
+        ctx.aggregator.add(json_line)
+        ctx.out_lines = ctx.out_lines + 1
+
+
+def aggregate_one_log(ctx, cmds, pool):
+    # Like _process_one_log, but the lines go to ctx.aggregator (out_lines
+    # counts the aggregated ones); with a pool the chunks are aggregated by
+    # the workers and their groups merged here
+    args = ctx.args
+    ctx.in_lines = 0
+    ctx.out_lines = 0
+    prefilter = None
+    if args.prefilter:
+        prefilter = build_prefilter(cmds)
+    offsets = index_offsets(ctx.in_path, cmds)
+    if pool is None or offsets is not None or args.time_range is not None:
+        (infile, lines) = open_lines(args, ctx.in_path, offsets)
+        for (line_no, l) in lines:
+            aggregate_line(l, cmds, prefilter, ctx)
+            ctx.in_lines = ctx.in_lines + 1
+        infile.close()
+        if ctx.stats is not None:
+            ctx.stats.in_lines = ctx.stats.in_lines + ctx.in_lines
+            ctx.stats.out_lines = ctx.stats.out_lines + ctx.out_lines
+    else:
+        (infile, tasks) = chunk_tasks(ctx)
+        for (groups, chunk_in_lines, messages, stats) in bounded_imap(pool, process_chunk, tasks, 2 * args.jobs):
+            ctx.flush_messages(messages, ctx.in_lines)
+            if stats is not None:
+                ctx.stats.merge(stats)
+                ctx.stats.maybe_report(time.time())
+            ctx.aggregator.merge(groups)
+            ctx.in_lines = ctx.in_lines + chunk_in_lines
+            ctx.out_lines = ctx.out_lines + groups['lines']
+        if infile is not None:
+            infile.close()
+    return (ctx.in_lines, ctx.out_lines)
+
+
+def index_path(inpath):
+    return inpath + INDEX_SUFFIX
+
+
+def load_index(inpath):
+    # Returns the sidecar index of inpath, or None if missing or stale
+    try:
+        with open(index_path(inpath), 'rb') as f:
+            index = marshal.load(f)
+        st = os.stat(inpath)
+    except (IOError, OSError, EOFError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    if index['size'] != st.st_size or index['mtime'] != st.st_mtime:
+        return None
+    return index
+
+
+def build_index(inpath, keys, args):
+    # Maps each string value of each key path to the byte offsets of the lines
+    # holding it. Keys already in a valid index are kept and not rescanned.
+    index = load_index(inpath)
+    if index is None:
+        st = os.stat(inpath)
+        index = {'version': INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime, 'keys': {}}
+    keys = [k for k in keys if not k in index['keys']]
+    if not keys:
+        return index
+    values = dict([(k, {}) for k in keys])
+    offset = 0
+    with open(inpath, 'rb') as infile:
+        for l in infile:
+            json_line = to_json_line(l, args)
+            for k in keys:
+                v = jtree_get(json_line, k)
+                if isinstance(v, basestring):
+                    if isinstance(v, unicode):
+                        v = v.encode('utf-8')
+                    values[k].setdefault(v, []).append(offset)
+            offset = offset + len(l)
+    index['keys'].update(values)
+    tmp_path = index_path(inpath) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, index_path(inpath))
+    return index
+
+
+def index_lookup(index, selectors):
+    # Offsets of the lines that may match all of selectors, or None if no
+    # selector can be answered from the index
+    offsets = None
+    for selector in selectors:
+        if selector['operator_name'] != '==' or selector['segments'] is None:
+            continue
+        if not all(isinstance(seg, str) for seg in selector['segments']):
+            continue
+        values = index['keys'].get(selector['path_selector'])
+        if values is None:
+            continue
+        found = set(values.get(selector['operand'], []))
+        offsets = found if offsets is None else offsets & found
+    if offsets is None:
+        return None
+    return sorted(offsets)
+
+
+def index_offsets(inpath, cmds):
+    # Offsets of the lines that may pass the -lk commands the command list
+    # starts with, from a valid sidecar index of inpath; None to read all lines.
+    # The commands still run on every line read.
+    keeps = []
+    for cmd in cmds:
+        if cmd['command'] != 'line_keep':
+            break
+        keeps.append(cmd)
+    if not keeps or not is_plain_file(inpath):
+        return None
+    index = load_index(inpath)
+    if index is None:
+        return None
+    return index_lookup(index, keeps)
 
-    in_file_name = os.path.split(inpath)[1]
-    out_file_name = os.path.split(outpath)[1]
-    infile = open(inpath, 'r')
-    outfile = open(outpath, 'w')
-
-    in_lines = 0
-    out_lines = 0
-    if args.beautify == 'array':
-        outfile.write('[\n')
-    elif args.beautify == 'dict':
-        outfile.write('{\n')
-    for l in infile:
-        json_line = to_json_line(l, args)
-        json_line = process_line(json_line, cmds)
+
+def line_time(line, args):
+    try:
+        json_line = to_json_line(line, args)
+    except ValueError:
+        return None
+    return parse_time(jtree_get(json_line, args.time_key))
+
+
+def _first_timed_line(f, offset, args):
+    # (start, time) of the first line starting at or after offset that has a
+    # timestamp, or (None, None) at the end of the file
+    if offset > 0:
+        f.seek(offset - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    while True:
+        start = f.tell()
+        l = f.readline()
+        if not l:
+            return (None, None)
+        t = line_time(l, args)
+        if t is not None:
+            return (start, t)
+
+
+def seek_time(f, size, t, args):
+    # Binary search for the offset of the first line timed at or after t;
+    # size if there is none
+    lo = 0
+    hi = size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        (start, line_t) = _first_timed_line(f, mid, args)
+        if start is None or line_t >= t:
+            hi = mid
+        else:
+            lo = start + 1
+    (start, line_t) = _first_timed_line(f, lo, args)
+    if start is None:
+        return size
+    return start
+
+
+def _count_lines(f, start, end):
+    # Newlines between the byte offsets start and end of f
+    f.seek(start)
+    count = 0
+    left = end - start
+    while left > 0:
+        block = f.read(min(left, IO_BUFFER_SIZE))
+        if not block:
+            break
+        count = count + block.count('\n')
+        left = left - len(block)
+    return count
+
+
+def _range_lines(f, start, end, numbered):
+    line_no = 0
+    if numbered:
+        line_no = _count_lines(f, 0, start)
+    f.seek(start)
+    pos = start
+    for l in f:
+        if end is not None and pos >= end:
+            break
+        yield (line_no, l)
+        line_no = line_no + 1
+        pos = pos + len(l)
+
+
+def _time_filter_lines(lines, time_range, args):
+    # Linear --since/--until for inputs that can't be searched; lines without
+    # a timestamp go along with the lines around them
+    (since, until) = time_range
+    started = since is None
+    for (line_no, l) in lines:
+        t = line_time(l, args)
+        if t is not None:
+            if until is not None and t >= until:
+                return
+            if not started and t >= since:
+                started = True
+        if started:
+            yield (line_no, l)
+
+
+def _seek_lines(infile, offsets, numbered):
+    line_no = 0
+    pos = 0
+    for offset in offsets:
+        if numbered:
+            line_no = line_no + _count_lines(infile, pos, offset)
+        infile.seek(offset)
+        l = infile.readline()
+        yield (line_no, l)
+        line_no = line_no + 1
+        pos = offset + len(l)
+
+
+def open_lines(args, inpath, offsets=None, numbered=False):
+    # Returns (file, lines) where lines are the (line_no, line) of inpath
+    # within --since/--until, and if offsets (from index_offsets) are given
+    # only those lines. In plain files the time range is binary searched; the
+    # lines skipped are only counted (for line_no) if numbered, otherwise the
+    # lines read are numbered in order.
+    if offsets is None and args.time_range is None:
+        infile = open_input(inpath, IO_BUFFER_SIZE)
+        return (infile, enumerate(infile))
+    if not is_plain_file(inpath):
+        infile = open_input(inpath, IO_BUFFER_SIZE)
+        lines = enumerate(infile)
+        if args.time_range is not None:
+            lines = _time_filter_lines(lines, args.time_range, args)
+    else:
+        infile = open(inpath, 'rb')
+        start = 0
+        end = None
+        if args.time_range is not None:
+            (since, until) = args.time_range
+            size = os.fstat(infile.fileno()).st_size
+            if since is not None:
+                start = seek_time(infile, size, since, args)
+            if until is not None:
+                end = seek_time(infile, size, until, args)
+        if offsets is not None:
+            offsets = [o for o in offsets if o >= start and (end is None or o < end)]
+            lines = _seek_lines(infile, offsets, numbered)
+        else:
+            lines = _range_lines(infile, start, end, numbered)
+    return (infile, lines)
+
+
+def process_index(args):
+    for inpath in args.infiles:
+        index = build_index(inpath, args.index, args)
+        if (args.verbose > 0):
+            say(args, 'Indexed "%s" --> "%s"' % (inpath, index_path(inpath)))
+            for k in args.index:
+                say(args, '%10d values  %s' % (len(index['keys'][k]), k))
+
+
+def process_one_log(ctx, cmds, pool=None):
+    start = time.time()
+    result = _process_one_log(ctx, cmds, pool)
+    if ctx.stats is not None:
+        ctx.stats.add_file(ctx, time.time() - start)
+    return result
+
+
+def _process_one_log(ctx, cmds, pool):
+    args = ctx.args
+    if args.follow:
+        checkpoint_path = args.checkpoints[args.infiles.index(ctx.in_path)]
+        return follow_one_log(ctx, cmds, checkpoint_path)
+    if args.sort:
+        return sort_one_log(ctx, cmds)
+    if args.aggregate:
+        return aggregate_one_log(ctx, cmds, pool)
+    outfile = open_output(ctx.out_path, IO_BUFFER_SIZE)
+    writer = OutputWriter(outfile, args.beautify)
+
+    ctx.in_lines = 0
+    ctx.out_lines = 0
+    writer.begin()
+    offsets = index_offsets(ctx.in_path, cmds)
+    if pool is None or offsets is not None or args.time_range is not None:
+        prefilter = None
+        if args.prefilter:
+            prefilter = build_prefilter(cmds)
+        process = line_processor(ctx)
+        (infile, lines) = open_lines(args, ctx.in_path, offsets, args.beautify == 'dict')
+        for (line_no, l) in lines:
+            oline = process(l, cmds, prefilter, ctx)
+            if oline is not None:
+                writer.write(oline, line_no)
+                ctx.out_lines = ctx.out_lines + 1
+            ctx.in_lines = ctx.in_lines + 1
+        infile.close()
+    else:
+        (infile, tasks) = chunk_tasks(ctx)
+        for (outputs, chunk_in_lines, messages, stats) in bounded_imap(pool, process_chunk, tasks, 2 * args.jobs):
+            writer.flush()
+            ctx.flush_messages(messages, ctx.in_lines)
+            if stats is not None:
+                ctx.stats.merge(stats)
+                ctx.stats.maybe_report(time.time())
+            for (line_no, oline) in outputs:
+                writer.write(oline, ctx.in_lines + line_no)
+                ctx.out_lines = ctx.out_lines + 1
+            ctx.in_lines = ctx.in_lines + chunk_in_lines
+        if infile is not None:
+            infile.close()
+    writer.end()
+    outfile.close()
+    return (ctx.in_lines, ctx.out_lines)
+
+
+def process_files(args, cmds, stats=None, aggregator=None):
+    # Returns (inpath, outpath, in_lines, out_lines) for each input file
+    summary = []
+    if args.file_jobs > 1:
+        pool = multiprocessing.Pool(args.file_jobs, init_worker, (args, raw_commands(cmds)))
+        tasks = zip(args.infiles, args.outfiles)
+        for (infile, outfile, in_lines, out_lines, messages, file_stats, groups) in pool.imap(process_file_job, tasks):
+            LogContext(args, infile, outfile).flush_messages(messages)
+            if file_stats is not None:
+                stats.merge(file_stats)
+                stats.maybe_report(time.time())
+            if groups is not None:
+                aggregator.merge(groups)
+            if (args.verbose > 0):
+                say(args, 'Processed "%s" --> "%s"' % (str(infile), str(outfile)))
+                say(args, 'Input %d lines --> Output %d lines' % (in_lines, out_lines))
+            summary.append((infile, outfile, in_lines, out_lines))
+        pool.close()
+        pool.join()
+        return summary
+
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, init_worker, (args, raw_commands(cmds)))
+    for (infile, outfile) in zip(args.infiles, args.outfiles):
+        if (args.verbose > 0):
+            say(args, 'Processing "%s" --> "%s"' % (str(infile), str(outfile)))
+        ctx = LogContext(args, infile, outfile)
+        ctx.stats = stats
+        ctx.aggregator = aggregator
+        (in_lines, out_lines) = process_one_log(ctx, cmds, pool)
+        if (args.verbose > 0):
+            say(args, 'Input %d lines --> Output %d lines' % (in_lines, out_lines))
+        summary.append((infile, outfile, in_lines, out_lines))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return summary
+
+
+def print_summary(args, summary):
+    total_in = total_out = 0
+    say(args, 'Summary')
+    for (infile, outfile, in_lines, out_lines) in summary:
+        say(args, '%10d %10d  %s' % (in_lines, out_lines, infile))
+        total_in = total_in + in_lines
+        total_out = total_out + out_lines
+    say(args, '%10d %10d  total (%d files)' % (total_in, total_out, len(summary)))
+
+
+# Values of different JSON types order by type first, so any mix of types
+# (and missing keys, which read as None) still sorts deterministically
+SORT_TYPE_RANKS = [
+    (type(None), 0),
+    (bool, 1),
+    ((int, long, float), 2),
+    (basestring, 3),
+    (list, 4),
+    (dict, 5),
+]
+
+
+def sort_value(val):
+    for (types, rank) in SORT_TYPE_RANKS:
+        if isinstance(val, types):
+            if rank == 4:
+                return (rank, [sort_value(v) for v in val])
+            if rank == 5:
+                return (rank, sorted([(k, sort_value(v)) for (k, v) in val.items()]))
+            return (rank, val)
+    return (len(SORT_TYPE_RANKS), val)
+
+
+def line_sort_key(json_line, keys):
+    return tuple([sort_value(jtree_get(json_line, k)) for k in keys])
+
+
+def process_merge(infiles, outfile, args, cmds, stats=None):
+    # k-way merge of logs that are each sorted by args.merge. Only the current
+    # line of every input is held in memory; ties keep the order of infiles.
+    ctx = LogContext(args, '', outfile)
+    ctx.stats = stats
+    start = time.time()
+    transform = process_line
+    if stats is not None:
+        transform = process_line_stats
+    opened = [open_lines(args, inpath, index_offsets(inpath, cmds)) for inpath in infiles]
+    readers = [reader for (reader, reader_lines) in opened]
+    lines = [iter(reader_lines) for (reader, reader_lines) in opened]
+    heap = []
+
+    def push_next(idx):
+        (line_no, l) = next(lines[idx], (None, None))
+        if l is not None:
+            json_line = to_json_line(l, args)
+            heapq.heappush(heap, (line_sort_key(json_line, args.merge), idx, l, json_line))
+
+    for idx in range(len(infiles)):
+        push_next(idx)
+
+    outfile = open_output(outfile, IO_BUFFER_SIZE)
+    writer = OutputWriter(outfile, args.beautify)
+    writer.begin()
+    while heap:
+        (key, idx, l, json_line) = heapq.heappop(heap)
+        ctx.in_file_name = os.path.split(infiles[idx])[1]
+        ctx.line_changed = False
+        json_line = transform(json_line, cmds, ctx)
         if json_line:
-            if out_lines > 0:
-                if args.beautify != 'none':
-                    outfile.write(',')
-                outfile.write('\n')
-            oline = output_line(json_line, args)
-            out_lines = out_lines + 1
-            if args.beautify == 'dict':
-                outfile.write('"%d": ' % (in_lines))
-            outfile.write(oline)
-        in_lines = in_lines + 1
-    if args.beautify == 'array':
-        outfile.write('\n}')
-    elif args.beautify == 'dict':
-        outfile.write('\n]')
-    return (in_lines, out_lines)
-
-def process_merge(infiles, outfile, args):
-    pass
-#   in_lines = 0
-#   out_lines = 0
-#   if (args.verbose > 0):
-#       print('Processing %s --> %s' % (str(infiles), str(outfile)))    
-#   filesnum = len(infiles)
-#   # First lines
-#   lines = []
-#   for f in infiles:
-#       l = f.readline()
+            if args.beautify == 'none' and not ctx.line_changed:
+                oline = l.rstrip('\r\n')
+            else:
+                oline = output_line(json_line, args)
+            writer.write(oline, ctx.in_lines)
+            ctx.out_lines = ctx.out_lines + 1
+        ctx.in_lines = ctx.in_lines + 1
+        push_next(idx)
+    writer.end()
+    outfile.close()
+    for reader in readers:
+        reader.close()
+
+    if stats is not None:
+        stats.in_lines = stats.in_lines + ctx.in_lines
+        stats.out_lines = stats.out_lines + ctx.out_lines
+        ctx.in_path = ','.join(infiles)
+        stats.add_file(ctx, time.time() - start)
+    return (ctx.in_lines, ctx.out_lines)
 
 
 def main(argv): 
@@ -571,25 +2857,38 @@ def main(argv):
     args = parse_args(argv)
 
     if (args.verbose >= 2):
-        print argv
+        say(args, str(argv))
 
     cmds = build_commands_list(args)
     if (args.verbose >= 1):
-        print('Commands by order')
+        say(args, 'Commands by order')
         for (idx, cmd) in enumerate(cmds):
-            print('(%02d) %s(%s)' % (idx, cmd['command'], cmd['selector']))         
+            say(args, '(%02d) %s(%s)' % (idx, cmd['command'], cmd['selector']))
+
+    if args.index:
+        process_index(args)
+        return
 
-    if (False):     # args.merge
-        process_merge(args.infiles, args.outfiles[0], args)
+    stats = None
+    if args.stats:
+        stats = ProcessStats(cmds, args.stats, args.stats_interval, get_memo(args))
+    if args.merge:
+        if (args.verbose > 0):
+            say(args, 'Merging %s --> "%s"' % (str(args.infiles), str(args.outfiles[0])))
+        (in_lines, out_lines) = process_merge(args.infiles, args.outfiles[0], args, cmds, stats)
+        if (args.verbose > 0):
+            say(args, 'Input %d lines --> Output %d lines' % (in_lines, out_lines))
     else:
-        for (idx, inf) in enumerate(args.infiles):
-            infile = args.infiles[idx]
-            outfile = args.outfiles[idx]
-            if (args.verbose > 0):
-                print('Processing "%s" --> "%s"' % (str(infile), str(outfile)))         
-            (in_lines, out_lines) = process_one_log(infile, outfile, cmds)
-            if (args.verbose > 0):
-                print('Input %d lines --> Output %d lines' % (in_lines, out_lines))
+        aggregator = None
+        if args.aggregate:
+            aggregator = Aggregator(args.group_by, args.agg)
+        summary = process_files(args, cmds, stats, aggregator)
+        if (args.verbose > 0) and len(summary) > 1:
+            print_summary(args, summary)
+        if aggregator is not None:
+            print(aggregator.table())
+    if stats is not None:
+        stats.report(final=True)
 
 if __name__ == "__main__":
     main(sys.argv)
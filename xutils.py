@@ -1,4 +1,30 @@
+import sys
+import os.path
 import glob
+import gzip
+import bz2
+import signal
+import marshal
+import tempfile
+import threading
+import subprocess
+import collections
+import Queue
+
+STDIO_PATH = '-'
+READ_BLOCK_SIZE = 1024 * 1024
+READ_AHEAD_BLOCKS = 16
+OUTPUT_BATCH_SIZE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_SORT_MEMORY = 256 * 1024 * 1024
+SORT_RECORD_OVERHEAD = 200     # Rough per-record memory beyond its text
+
+# Extension: (external tool, python fallback opener)
+COMPRESSORS = {
+    '.gz': ('gzip', lambda path, mode: gzip.open(path, mode)),
+    '.bz2': ('bzip2', lambda path, mode: bz2.BZ2File(path, mode)),
+    '.xz': ('xz', lambda path, mode: _lzma_open(path, mode)),
+}
 
 
 def remove_duplicates(string_list):
@@ -17,8 +43,235 @@ def expand_file_paths(files):
         return []
     if not isinstance(files, list):
         files = [files]
-    globbed_lists = [glob.glob(fpath) for fpath in files]
+    globbed_lists = [[fpath] if fpath == STDIO_PATH else glob.glob(fpath) for fpath in files]
     expanded = []
     for g in globbed_lists:
         expanded = expanded + g 
     return remove_duplicates(expanded)
+
+
+def _lzma_open(path, mode):
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return lzma.LZMAFile(path, mode)
+
+
+def compression_ext(path):
+    for ext in COMPRESSORS:
+        if path.endswith(ext):
+            return ext
+    return None
+
+
+def is_plain_file(path):
+    return path != STDIO_PATH and compression_ext(path) is None
+
+
+def output_path(inpath, suffix):
+    # a.log -> a.log<suffix>, a.log.gz -> a.log<suffix>.gz, - -> -
+    if inpath == STDIO_PATH:
+        return STDIO_PATH
+    ext = compression_ext(inpath)
+    if ext is None:
+        return inpath + suffix
+    return inpath[:-len(ext)] + suffix + ext
+
+
+class ThreadedReader(object):
+    # Reads (and decompresses) a file object in a background thread, so that
+    # I/O overlaps with processing. Iterates lines like a file.
+
+    def __init__(self, f, block_size=READ_BLOCK_SIZE, depth=READ_AHEAD_BLOCKS):
+        self.f = f
+        self.block_size = block_size
+        self.blocks = Queue.Queue(depth)
+        self.thread = threading.Thread(target=self._read_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_blocks(self):
+        try:
+            while True:
+                block = self.f.read(self.block_size)
+                self.blocks.put(block)
+                if not block:
+                    break
+        except BaseException as e:
+            self.blocks.put(e)
+
+    def __iter__(self):
+        rest = ''
+        while True:
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                raise block
+            if not block:
+                break
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            for l in lines:
+                yield l + '\n'
+        if rest:
+            yield rest
+
+    def close(self):
+        self.f.close()
+
+
+def _restore_sigpipe():
+    # Python ignores SIGPIPE, which children inherit: let the decompressor die
+    # quietly when we stop reading early instead of failing with EPIPE
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class PipeReader(object):
+    # Reads the output of an external decompressor running as its own process
+
+    def __init__(self, cmd, bufsize=-1):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=bufsize, close_fds=True,
+            preexec_fn=_restore_sigpipe)
+
+    def __iter__(self):
+        return iter(self.proc.stdout)
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        # A negative status means it was stopped by SIGPIPE after an early close
+        self.proc.stdout.close()
+        if self.proc.wait() > 0:
+            raise IOError('error: %s failed' % (' '.join(self.cmd)))
+
+
+class PipeWriter(object):
+    # Writes through an external compressor running as its own process
+
+    def __init__(self, cmd, path, bufsize=-1):
+        self.cmd = cmd
+        self.outfile = open(path, 'wb')
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.outfile,
+                bufsize=bufsize, close_fds=True)
+        except OSError:
+            self.outfile.close()
+            raise
+
+    def write(self, s):
+        self.proc.stdin.write(s)
+
+    def flush(self):
+        self.proc.stdin.flush()
+
+    def close(self):
+        self.proc.stdin.close()
+        status = self.proc.wait()
+        self.outfile.close()
+        if status != 0:
+            raise IOError('error: %s failed writing %s' % (' '.join(self.cmd), self.outfile.name))
+
+
+class StdoutWriter(object):
+    # sys.stdout that is flushed, not closed, when done
+
+    def write(self, s):
+        sys.stdout.write(s)
+
+    def flush(self):
+        sys.stdout.flush()
+
+    def close(self):
+        sys.stdout.flush()
+
+
+def open_input(path, bufsize=-1):
+    if path == STDIO_PATH:
+        return sys.stdin
+    ext = compression_ext(path)
+    if ext is None:
+        return open(path, 'r', bufsize)
+    (tool, opener) = COMPRESSORS[ext]
+    try:
+        return PipeReader([tool, '-dc', path], bufsize)
+    except OSError:
+        return ThreadedReader(opener(path, 'rb'))
+
+
+def open_output(path, bufsize=-1):
+    if path == STDIO_PATH:
+        return StdoutWriter()
+    ext = compression_ext(path)
+    if ext is None:
+        return open(path, 'w', bufsize)
+    (tool, opener) = COMPRESSORS[ext]
+    try:
+        return PipeWriter([tool, '-c'], path, bufsize)
+    except OSError:
+        return opener(path, 'wb')
+
+
+def find_chunks(inpath, chunk_size, start=0):
+    # Splits a file from start into (start, end) byte ranges that end on a
+    # line boundary
+    size = os.path.getsize(inpath)
+    chunks = []
+    with open(inpath, 'r') as f:
+        while start < size:
+            end = start + max(chunk_size, 1)
+            if end < size:
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            else:
+                end = size
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def spill_run(run, prefix):
+    # Sorts a run and writes it to a temporary file as marshal records
+    run.sort()
+    f = tempfile.TemporaryFile(prefix=prefix)
+    for record in run:
+        marshal.dump(record, f)
+    f.seek(0)
+    return f
+
+
+def read_run(f):
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            return
+
+
+def read_line_batches(infile, batch_size):
+    # Groups the lines of a stream into lists of about batch_size bytes
+    batch = []
+    size = 0
+    for l in infile:
+        batch.append(l)
+        size = size + len(l)
+        if size >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def bounded_imap(pool, func, tasks, window):
+    # Like pool.imap, but with at most window tasks in flight, so that a
+    # long (or endless) task stream is not read into memory ahead of time
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()